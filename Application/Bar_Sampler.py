@@ -0,0 +1,408 @@
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+# Streaming bar sampling: minute bars are fed to a BarSampler chunk by chunk and a sampling rule decides where each
+# bar closes. Only the minutes of the bar that is still open at the end of a chunk are carried into the next chunk,
+# so memory is bounded by the chunk size no matter how long the history is. Every rule emits the same columns.
+bar_dtypes = {
+    'open': float,
+    'high': float,
+    'low': float,
+    'close': float,
+    'volume': float,
+    'buy_volume': int,
+    'minutes': int,
+    'bull_minutes': int,
+    'dollar_volume': float,
+    'intrabar_volume_trend': float,
+}
+
+#
+# Vectorized bar helpers
+#
+def next_threshold_bar_end(values, threshold, start):
+    # A bar closes on the first minute where the value accumulated since the bar opened reaches that minute's
+    # threshold. The running sum is a np.cumsum from the bar's first minute, which adds in the same order as a running
+    # Python sum, so boundaries match a minute-by-minute loop exactly. Returns (bar_end, bar_sum, complete), a bar that
+    # never reaches its threshold runs to the last minute.
+    n_minutes = len(values)
+    window = 64
+    while True:
+        stop = min(n_minutes, start + window)
+        value_cumsum = np.cumsum(values[start:stop])
+        reached = np.flatnonzero(value_cumsum >= threshold[start:stop]) # nan thresholds are never reached
+        if len(reached) > 0:
+            return start + reached[0], value_cumsum[reached[0]], True
+        if stop == n_minutes:
+            return n_minutes - 1, value_cumsum[-1], False
+        window *= 4
+
+def scan_threshold_bars(values, threshold):
+    # Every bar from the first minute on (see next_threshold_bar_end). Returns (bar_starts, bar_ends, bar_sums, last_bar_complete).
+    bar_starts = []
+    bar_ends = []
+    bar_sums = []
+    last_bar_complete = True
+    start = 0
+    while start < len(values):
+        end, bar_sum, last_bar_complete = next_threshold_bar_end(values, threshold, start)
+        bar_starts.append(start)
+        bar_ends.append(end)
+        bar_sums.append(bar_sum)
+        start = end + 1
+    return np.array(bar_starts, dtype=np.int64), np.array(bar_ends, dtype=np.int64), np.array(bar_sums, dtype=float), last_bar_complete
+
+def sequential_segment_sums(values, starts, lengths, max_block_size=1 << 20):
+    # Left-to-right sum of each segment. np.add.reduceat sums pairwise, which can differ from a running sum in the
+    # last bits, so segments are padded with zeros into (segments x max length) blocks and summed with np.cumsum.
+    sums = np.empty(len(starts))
+    offsets = np.arange(lengths.max()) if len(lengths) > 0 else np.arange(0)
+    block_start = 0
+    while block_start < len(starts):
+        block_stop = block_start + 1
+        max_length = lengths[block_start]
+        while block_stop < len(starts) and (block_stop - block_start + 1) * max(max_length, lengths[block_stop]) <= max_block_size:
+            max_length = max(max_length, lengths[block_stop])
+            block_stop += 1
+        idx = starts[block_start:block_stop, None] + offsets[:max_length]
+        in_segment = offsets[:max_length] < lengths[block_start:block_stop, None]
+        padded = np.where(in_segment, values[np.minimum(idx, len(values) - 1)], 0.0)
+        sums[block_start:block_stop] = np.cumsum(padded, axis=1)[:, -1]
+        block_start = block_stop
+    return sums
+
+def pearson_corr_with_monotonic_increasing(volume, starts, lengths):
+    # Pearson correlation of each bar's minute volumes with 0, 1, 2, ... computed for all bars in one pass from
+    # per-bar sums. Sums are taken around each bar's mean volume (rather than from raw sums of v and v^2) so large
+    # volumes don't cancel out. The minute index has mean (m - 1) / 2 and sum of squared deviations m(m^2 - 1) / 12.
+    if len(starts) == 0:
+        return np.zeros(0)
+    lengths_f = lengths.astype(float)
+    volume = volume[starts[0]:starts[-1] + lengths[-1]] # bars are contiguous
+    starts = starts - starts[0]
+    minute_idx = np.arange(len(volume)) - np.repeat(starts, lengths)
+
+    volume_dev = volume - np.repeat(np.add.reduceat(volume, starts) / lengths_f, lengths)
+    idx_dev = minute_idx - np.repeat((lengths_f - 1) / 2, lengths)
+    covariance = np.add.reduceat(idx_dev * volume_dev, starts)
+    volume_var = np.add.reduceat(volume_dev * volume_dev, starts)
+    idx_var = lengths_f * (lengths_f * lengths_f - 1) / 12
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = covariance / np.sqrt(idx_var * volume_var) # nan for constant volumes, as with np.corrcoef
+
+    # Sometimes a single 1-minute bar has enough volume to produce a dollar bar. There is no way to calculate a
+    # correlation with a single value. A correlation calculate with 2 values is also not very useful as it will often
+    # have an extreme value. 0.0 is neutral
+    corr[lengths < 3] = 0.0
+    return corr
+
+def aggregate_bars(datetime, open, high, low, close, volume, bar_starts, bar_ends, previous_bar_close, minutes=None):
+    # Builds the bars DataFrame (indexed by datetime) from minute arrays and bar boundaries. previous_bar_close is the
+    # close of the bar before the first one, minutes defaults to the number of minutes in each bar.
+    bar_lengths = bar_ends - bar_starts + 1
+    if len(bar_starts) == 0:
+        return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in bar_dtypes.items()},
+                            index=pd.DatetimeIndex([], dtype='datetime64[ns]', name='datetime'))
+
+    # Minutes after the last bar (the bar still open in a streamed chunk) must not reach the reductions
+    stop = bar_ends[-1] + 1
+    open, high, low, close, volume = open[:stop], high[:stop], low[:stop], close[:stop], volume[:stop]
+
+    # According to the tick rule, a 1-minute bar is a "buy tick" if it closes above the close of the previous bar
+    previous_bar_closes = np.concatenate([[previous_bar_close], close[bar_ends[:-1]]])
+    buy_ticks = np.zeros(stop, dtype=bool)
+    buy_ticks[bar_starts[0]:] = close[bar_starts[0]:] > np.repeat(previous_bar_closes, bar_lengths)
+
+    bars = pd.DataFrame({
+        'datetime': datetime[bar_ends],
+        'open': open[bar_starts],
+        'high': np.maximum.reduceat(high, bar_starts),
+        'low': np.minimum.reduceat(low, bar_starts),
+        'close': close[bar_ends],
+        'volume': sequential_segment_sums(volume, bar_starts, bar_lengths),
+        'buy_volume': sequential_segment_sums(np.where(buy_ticks, volume, 0.0), bar_starts, bar_lengths),
+        'minutes': bar_lengths if minutes is None else minutes,
+        'bull_minutes': np.add.reduceat(buy_ticks.astype(int), bar_starts),
+        'dollar_volume': sequential_segment_sums(close * volume, bar_starts, bar_lengths),
+        'intrabar_volume_trend': pearson_corr_with_monotonic_increasing(volume, bar_starts, bar_lengths),
+    })
+    return bars.set_index('datetime', drop=True).astype(bar_dtypes)
+
+def minute_thresholds(thresholds, datetime):
+    # Threshold of every minute: the latest daily threshold at or before the minute (nan before the first day)
+    day_idx = np.searchsorted(thresholds.index.to_numpy(dtype='datetime64[ns]'), datetime, side='right') - 1
+    if len(thresholds) == 0:
+        return np.full(len(datetime), np.nan)
+    return np.where(day_idx >= 0, thresholds.to_numpy(dtype=float)[np.maximum(day_idx, 0)], np.nan)
+
+def daily_thresholds(daily_totals, optimal_n_bars_per_day=50, threshold_window=60):
+    # Threshold of each day: the rolling mean daily total over threshold_window trading days split into
+    # optimal_n_bars_per_day bars
+    mean_daily_totals = daily_totals.rolling(threshold_window, min_periods=1).mean()
+    return (mean_daily_totals / optimal_n_bars_per_day).rename('threshold')
+
+#
+# Sampling rules
+#
+# Every rule subclasses ThresholdBarRule and implements the two methods the samplers call:
+#  - daily_totals(minute_bars): Series of per-day totals, the daily thresholds are their rolling mean split into
+#    optimal_n_bars_per_day bars (used by DataDownloader).
+#  - scan(rows, threshold): bar boundaries (bar_starts, bar_ends, last_bar_complete) over a block of minute rows
+#    ({column: np.ndarray}) given each minute's threshold (used by BarSampler). The last bar may still be open.
+# The default scan closes a bar once the running sum of minute_values(rows) reaches the threshold. Rules whose scan
+# depends on earlier scans set stateful = True, they can only be streamed in order (not built by build_threshold_bars).
+class ThresholdBarRule():
+    stateful = False
+
+    def daily_totals(self, minute_bars):
+        raise NotImplementedError(f'{type(self).__name__} does not define daily_totals')
+
+    def minute_values(self, rows):
+        # Value of every minute that is summed into bars by the default scan
+        raise NotImplementedError(f'{type(self).__name__} does not sum minute values')
+
+    def scan(self, rows, threshold):
+        bar_starts, bar_ends, bar_sums, last_bar_complete = scan_threshold_bars(self.minute_values(rows), threshold)
+        return bar_starts, bar_ends, last_bar_complete
+
+class DollarBarRule(ThresholdBarRule):
+    def minute_values(self, rows):
+        return rows['close'] * rows['volume']
+
+    def daily_totals(self, minute_bars):
+        return (minute_bars.close.resample('1D').mean() * minute_bars.volume.resample('1D').sum()).dropna()
+
+class VolumeBarRule(ThresholdBarRule):
+    def minute_values(self, rows):
+        return rows['volume']
+
+    def daily_totals(self, minute_bars):
+        return minute_bars.volume.resample('1D').sum(min_count=1).dropna()
+
+class TickBarRule(ThresholdBarRule):
+    # Trade count bars (polygon.io minute aggs carry the number of trades, not the ticks themselves)
+    def minute_values(self, rows):
+        return np.nan_to_num(rows['trades'])
+
+    def daily_totals(self, minute_bars):
+        return minute_bars.trades.resample('1D').sum(min_count=1).dropna()
+
+class TickImbalanceBarRule(ThresholdBarRule):
+    # Tick imbalance bars (Lopez de Prado): each minute is signed by the tick rule (+1 if it closes above the previous
+    # minute, -1 below, the previous sign if unchanged) and a bar closes once |sum of signs| reaches
+    # E[minutes per bar] * E[|imbalance|]. Both expectations are EWMAs over the finished bars, using each bar's
+    # absolute mean sign (an EWMA of the signed means goes to 0 in a balanced market and every minute becomes a bar).
+    # The expected bar length is kept within 1/2 and 2x of the daily threshold (the mean minutes per day /
+    # optimal_n_bars_per_day), and the first bar is a plain run of that many minutes to seed the expectations.
+    stateful = True
+
+    def __init__(self, ewm_span=20):
+        self.alpha = 2 / (ewm_span + 1)
+        self.expected_length = None
+        self.expected_imbalance = None
+        self.previous_close = None # close and sign of the minute before the rows of the next scan
+        self.previous_sign = 0.0
+
+    def daily_totals(self, minute_bars):
+        minutes_per_day = minute_bars.close.resample('1D').count()
+        return minutes_per_day[minutes_per_day > 0].astype(float)
+
+    def tick_signs(self, close):
+        previous_close = close[0] if self.previous_close is None else self.previous_close
+        signs = np.sign(close - np.concatenate([[previous_close], close[:-1]]))
+        last_signed = np.maximum.accumulate(np.where(signs != 0, np.arange(len(signs)), -1))
+        return np.where(last_signed >= 0, signs[np.maximum(last_signed, 0)], self.previous_sign)
+
+    def scan(self, rows, threshold):
+        close = rows['close']
+        n_minutes = len(close)
+        if n_minutes == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), True
+        signs = self.tick_signs(close)
+
+        bar_starts = []
+        bar_ends = []
+        start = 0
+        while start < n_minutes:
+            baseline = threshold[start]
+            if np.isnan(baseline):
+                break
+            expected_length = baseline if self.expected_length is None else min(max(self.expected_length, baseline / 2), baseline * 2)
+
+            if self.expected_imbalance is None:
+                end = start + int(np.ceil(expected_length)) - 1
+                if end >= n_minutes:
+                    break
+            else:
+                bar_threshold = max(expected_length * self.expected_imbalance, 1.0)
+                window = 64
+                while True:
+                    stop = min(n_minutes, start + window)
+                    reached = np.flatnonzero(np.abs(np.cumsum(signs[start:stop])) >= bar_threshold)
+                    if len(reached) > 0 or stop == n_minutes:
+                        break
+                    window *= 4
+                if len(reached) == 0:
+                    break
+                end = start + reached[0]
+
+            bar_starts.append(start)
+            bar_ends.append(end)
+            bar_length = end - start + 1
+            bar_imbalance = abs(signs[start:end + 1].mean())
+            if self.expected_imbalance is None:
+                self.expected_length = float(bar_length)
+                self.expected_imbalance = bar_imbalance
+            else:
+                self.expected_length += self.alpha * (bar_length - self.expected_length)
+                self.expected_imbalance += self.alpha * (bar_imbalance - self.expected_imbalance)
+            start = end + 1
+
+        last_bar_complete = start >= n_minutes
+        if not last_bar_complete:
+            bar_starts.append(start)
+            bar_ends.append(n_minutes - 1)
+        if start > 0:
+            self.previous_close = close[start - 1]
+            self.previous_sign = signs[start - 1]
+        return np.array(bar_starts, dtype=np.int64), np.array(bar_ends, dtype=np.int64), last_bar_complete
+
+bar_sampling_rules = {'dollar': DollarBarRule,
+                      'volume': VolumeBarRule,
+                      'tick': TickBarRule,
+                      'tick_imbalance': TickImbalanceBarRule}
+
+#
+# Streaming engine
+#
+class BarSampler():
+    minute_columns = ['open', 'high', 'low', 'close', 'volume', 'trades']
+
+    def __init__(self, rule, thresholds, previous_bar_close=None):
+        self.rule = rule # Sampling rule instance (keeps its own state between chunks)
+        self.thresholds = thresholds # Series of daily thresholds indexed by day, the latest one at or before each minute applies
+        self._carry = None # key=column, value=np.ndarray, minutes of the bar still open
+        self._previous_bar_close = previous_bar_close # close of the bar before the first minute, None uses the first close
+
+    def process(self, minute_bars):
+        # Returns the bars completed by this chunk of minute bars (DatetimeIndex, in time order after earlier chunks)
+        rows = {'datetime': minute_bars.index.to_numpy(dtype='datetime64[ns]')}
+        for col in self.minute_columns:
+            rows[col] = minute_bars[col].to_numpy(dtype=float)
+        if self._carry is not None:
+            rows = {col: np.concatenate([self._carry[col], values]) for col, values in rows.items()}
+
+        bar_starts, bar_ends, last_bar_complete = self.rule.scan(rows, minute_thresholds(self.thresholds, rows['datetime']))
+        n_complete = len(bar_starts) if last_bar_complete else len(bar_starts) - 1
+        carry_start = bar_ends[n_complete - 1] + 1 if n_complete > 0 else 0
+        bars = self._aggregate(rows, bar_starts[:n_complete], bar_ends[:n_complete])
+        self._carry = {col: values[carry_start:] for col, values in rows.items()}
+        return bars
+
+    def flush(self):
+        # Closes the bar still open at the end of the data
+        rows = self._carry
+        self._carry = None
+        if rows is None or len(rows['close']) == 0:
+            return self._aggregate({col: np.zeros(0) for col in ['datetime'] + self.minute_columns}, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        return self._aggregate(rows, np.array([0]), np.array([len(rows['close']) - 1]))
+
+    def sample(self, minute_bar_chunks):
+        # Samples an iterable of minute bar chunks into one bars DataFrame
+        bars = [self.process(chunk) for chunk in minute_bar_chunks]
+        bars.append(self.flush())
+        return pd.concat(bars, axis=0)
+
+    def _aggregate(self, rows, bar_starts, bar_ends):
+        if len(bar_starts) > 0 and self._previous_bar_close is None:
+            self._previous_bar_close = rows['close'][0]
+        bars = aggregate_bars(rows['datetime'], rows['open'], rows['high'], rows['low'], rows['close'], rows['volume'],
+                              bar_starts, bar_ends, self._previous_bar_close)
+        if len(bar_ends) > 0:
+            self._previous_bar_close = rows['close'][bar_ends[-1]]
+        return bars
+
+#
+# Parallel builder for the threshold rules
+#
+def build_threshold_bars(minute_bars, rule, thresholds, n_jobs=-1, chunk_days=20, previous_bar_close=None):
+    # Builds the same bars as streaming minute_bars through a BarSampler, in parallel. The stateless threshold rules
+    # (dollar, volume, tick) only need to know where the open bar started to continue it, so:
+    #  1. Blocks of chunk_days days are scanned in parallel as if a bar opened on each block's first minute.
+    #  2. The true boundaries are stitched together in order. Where the previous block left a bar open, bars are
+    #     scanned from its start until one ends on a speculative boundary, from there on the block's bars are exact.
+    #  3. Bars are aggregated in parallel, one task per block.
+    # The number of tasks grows with the length of the history.
+    if rule.stateful:
+        raise ValueError(f'{type(rule).__name__} depends on the bars before each block, stream it through a BarSampler instead')
+    datetime = minute_bars.index.to_numpy(dtype='datetime64[ns]')
+    rows = {col: minute_bars[col].to_numpy(dtype=float) for col in BarSampler.minute_columns}
+    values = rule.minute_values(rows)
+    threshold = minute_thresholds(thresholds, datetime)
+    if len(datetime) == 0:
+        return aggregate_bars(datetime, *(rows[col] for col in ['open', 'high', 'low', 'close', 'volume']),
+                              np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), previous_bar_close)
+
+    # Contiguous blocks of chunk_days days
+    day_starts = np.flatnonzero(np.diff(datetime.astype('datetime64[D]'), prepend=datetime[:1].astype('datetime64[D]') - 1))
+    block_starts = np.append(day_starts[::max(1, chunk_days)], len(datetime))
+    blocks = list(zip(block_starts[:-1], block_starts[1:]))
+
+    def run(tasks):
+        if n_jobs == 1 or len(blocks) == 1:
+            return [function(*args) for function, args, kwargs in tasks]
+        return Parallel(n_jobs=n_jobs, max_nbytes=None)(tasks)
+
+    speculative = run(delayed(_scan_block)(values[start:stop], threshold[start:stop], start) for start, stop in blocks)
+    bar_starts, bar_ends = _stitch_blocks(values, threshold, blocks, speculative)
+
+    # Aggregate bars in groups that start in the same block
+    groups = np.searchsorted(bar_starts, block_starts[:-1])
+    groups = [(first, last) for first, last in zip(groups, np.append(groups[1:], len(bar_starts))) if first < last]
+    previous_bar_closes = np.concatenate([[rows['close'][0] if previous_bar_close is None else previous_bar_close], rows['close'][bar_ends[:-1]]])
+    bars = run(delayed(_aggregate_block)(
+        {col: column[bar_starts[first]:bar_ends[last - 1] + 1] for col, column in dict(rows, datetime=datetime).items()},
+        bar_starts[first:last] - bar_starts[first],
+        bar_ends[first:last] - bar_starts[first],
+        previous_bar_closes[first],
+    ) for first, last in groups)
+    return pd.concat(bars, axis=0)
+
+def _scan_block(values, threshold, offset):
+    # Speculative bar ends of a block (absolute minute indices), and whether the block's last bar closed inside it
+    bar_starts, bar_ends, bar_sums, last_bar_complete = scan_threshold_bars(values, threshold)
+    return bar_ends + offset, last_bar_complete
+
+def _stitch_blocks(values, threshold, blocks, speculative):
+    bar_ends = []
+    start = 0 # first minute of the next bar
+    for (block_start, block_stop), (block_bar_ends, last_bar_complete) in zip(blocks, speculative):
+        if start >= block_stop:
+            continue # the open bar covers the whole block
+        complete_bar_ends = block_bar_ends if last_bar_complete else block_bar_ends[:-1]
+
+        # Scan the bar left open by the previous block until a bar ends on a speculative boundary of this block
+        while start != block_start and start < block_stop:
+            end, bar_sum, complete = next_threshold_bar_end(values, threshold, start)
+            bar_ends.append(end)
+            start = end + 1
+            if (not complete) or end in complete_bar_ends:
+                break
+
+        # From a speculative boundary on, the block's speculative bars are the true ones
+        if block_start <= start < block_stop:
+            synced_bar_ends = complete_bar_ends[complete_bar_ends >= start]
+            bar_ends.extend(synced_bar_ends)
+            if len(synced_bar_ends) > 0: start = synced_bar_ends[-1] + 1
+
+    # The bar still open at the end of the data closes on the last minute
+    if start < len(values):
+        bar_ends.append(len(values) - 1)
+    bar_ends = np.array(bar_ends, dtype=np.int64)
+    return np.concatenate([[0], bar_ends[:-1] + 1]).astype(np.int64), bar_ends
+
+def _aggregate_block(rows, bar_starts, bar_ends, previous_bar_close):
+    return aggregate_bars(rows['datetime'], rows['open'], rows['high'], rows['low'], rows['close'], rows['volume'],
+                          bar_starts, bar_ends, previous_bar_close)
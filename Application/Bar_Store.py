@@ -0,0 +1,338 @@
+import os
+import json
+import time
+import threading
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+# Columnar bar format: one directory per symbol (Data/<symbol>) holding one .npy file per column and a meta.json
+# with the column names, dtypes, column files and row count. datetime is stored as int64 nanoseconds. Columns can be
+# loaded individually and memory-mapped. Legacy Data/<symbol>.pkl files are still readable (but always copied into memory).
+#
+# Column files are never overwritten: every write saves new files (<column>.<version>.npy) next to the old ones and
+# then swaps meta.json, so readers switch to the new version at once. Files meta.json no longer refers to are deleted
+# afterwards, except those still memory-mapped by some process (Windows can't delete mapped files), which are retried
+# on the next write.
+meta_file_name = 'meta.json'
+replace_retries = 5 # Attempts at swapping meta.json while another process has it open (Windows)
+legacy_suffix = '.pkl'
+bars_index_file_name = 'bars_index.json' # Metadata index of a bars directory (see load_bars_index)
+
+_bar_stores = {} # key=bar file path, value=BarStore
+_bar_stores_lock = threading.Lock()
+
+#
+# Columnar bar files
+#
+def write_bars(df, path):
+    # Writes a bars DataFrame (with a datetime column) to the columnar format, sorted by datetime. Replaces every
+    # column of an existing bars directory.
+    df = df.sort_values(by='datetime', ascending=True, kind='mergesort')
+    os.makedirs(path, exist_ok=True)
+    version = _new_version()
+
+    dtypes = {}
+    files = {}
+    for col in df.columns:
+        values = df[col].to_numpy()
+        if col == 'datetime':
+            values = pd.to_datetime(df[col]).to_numpy(dtype='datetime64[ns]').view(np.int64)
+            dtypes[col] = 'datetime64[ns]'
+        elif values.dtype == object:
+            raise ValueError(f'Column {col} has dtype object, only numeric and datetime columns can be stored')
+        else:
+            dtypes[col] = values.dtype.str
+        files[col] = _save_column(path, col, version, values)
+
+    _swap_meta(path, {'columns': list(df.columns), 'dtypes': dtypes, 'files': files, 'n_rows': len(df)})
+
+def add_bar_columns(path, columns):
+    # Adds (or replaces) columns of a columnar bars directory: {column: np.ndarray} with one value per row.
+    # Readers only see the new columns once meta.json is swapped.
+    meta = read_bar_meta(path)
+    version = _new_version()
+    files = meta.setdefault('files', {col: f'{col}.npy' for col in meta['columns']})
+    for col, values in columns.items():
+        values = np.ascontiguousarray(values)
+        if len(values) != meta['n_rows']:
+            raise ValueError(f'Column {col} has {len(values)} rows, {path} has {meta["n_rows"]}')
+        if values.dtype == object:
+            raise ValueError(f'Column {col} has dtype object, only numeric and datetime columns can be stored')
+        files[col] = _save_column(path, col, version, values)
+        if col not in meta['columns']: meta['columns'].append(col)
+        meta['dtypes'][col] = values.dtype.str
+
+    _swap_meta(path, meta)
+
+def _new_version():
+    return f'{time.time_ns():x}'
+
+def _save_column(path, col, version, values):
+    # Saves one column file of a new version and returns its file name
+    file_name = f'{col}.{version}.npy'
+    with open(os.path.join(path, file_name), 'wb') as f:
+        np.save(f, np.ascontiguousarray(values), allow_pickle=False)
+    return file_name
+
+def _swap_meta(path, meta):
+    # Switches readers to the column files in meta, then deletes the files it no longer refers to
+    tmp_meta = os.path.join(path, f'{meta_file_name}.tmp')
+    with open(tmp_meta, 'w') as f:
+        json.dump(meta, f)
+    for attempt in range(replace_retries):
+        try:
+            os.replace(tmp_meta, os.path.join(path, meta_file_name))
+            break
+        except PermissionError: # meta.json is being read by another process
+            if attempt == replace_retries - 1: raise
+            time.sleep(0.1 * (attempt + 1))
+
+    # This process's store maps the old files, other processes reload theirs once they see the new mtime
+    release_bar_store(path)
+    remove_stale_column_files(path, meta)
+
+def remove_stale_column_files(path, meta=None):
+    # Deletes the column files meta.json doesn't refer to. Files still memory-mapped somewhere are kept.
+    if meta is None: meta = read_bar_meta(path)
+    current = set(_column_files(meta).values())
+    for name in os.listdir(path):
+        if name.endswith(('.npy', '.npy.tmp')) and (name not in current):
+            try:
+                os.remove(os.path.join(path, name))
+            except PermissionError:
+                pass
+
+def _column_files(meta):
+    # Directories written before column files were versioned store <column>.npy
+    return meta.get('files', {col: f'{col}.npy' for col in meta['columns']})
+
+def read_bar_meta(path):
+    with open(os.path.join(path, meta_file_name)) as f:
+        return json.load(f)
+
+def read_bar_columns(path, columns=None, mmap_mode=None, meta=None):
+    # Returns {column: np.ndarray} for the requested columns (all columns if None). With mmap_mode='r' the
+    # columnar arrays are read-only memory maps. Legacy pickles are always read in full. meta (a read_bar_meta
+    # snapshot) pins the column files to that version, otherwise the current meta.json is read.
+    if is_legacy_bars_file(path):
+        data = pd.read_pickle(path)
+        data.datetime = pd.to_datetime(data.datetime)
+        data.sort_values(by='datetime', ascending=True, inplace=True, kind='mergesort')
+        if columns is None: columns = list(data.columns)
+        return {col: data[col].to_numpy(copy=True) for col in columns}
+
+    if meta is None: meta = read_bar_meta(path)
+    files = _column_files(meta)
+    if columns is None: columns = meta['columns']
+    bar_columns = {}
+    for col in columns:
+        if col not in meta['dtypes']:
+            raise KeyError(f'{col} is not stored in {path}')
+        values = np.load(os.path.join(path, files[col]), mmap_mode=mmap_mode, allow_pickle=False)
+        if mmap_mode is not None: values = np.asarray(values) # plain ndarray view onto the mapped pages
+        if meta['dtypes'][col] == 'datetime64[ns]': values = values.view('datetime64[ns]')
+        bar_columns[col] = values
+    return bar_columns
+
+def read_bars(path, columns=None, mmap_mode=None):
+    # DataFrame reader for the columnar format, column order follows the file unless columns is given
+    return pd.DataFrame(read_bar_columns(path, columns, mmap_mode), copy=False)
+
+def bars_mtime(path):
+    # meta.json is written last, so its mtime identifies the version of a columnar bars directory
+    if is_legacy_bars_file(path): return os.path.getmtime(path)
+    return os.path.getmtime(os.path.join(path, meta_file_name))
+
+def is_legacy_bars_file(path):
+    return path.endswith(legacy_suffix)
+
+def resolve_bars_file(bars_path, symbol):
+    # Accepts 'AAPL' or a legacy 'AAPL.pkl' and prefers the columnar directory when both exist
+    if symbol.endswith(legacy_suffix): symbol = symbol[:-len(legacy_suffix)]
+    columnar_path = os.path.join(bars_path, symbol)
+    if os.path.isfile(os.path.join(columnar_path, meta_file_name)):
+        return columnar_path
+    return os.path.join(bars_path, symbol + legacy_suffix)
+
+def list_symbols(bars_path):
+    # Symbols with bars in bars_path (columnar directories and legacy pickles)
+    symbols = set()
+    for name in os.listdir(bars_path):
+        if name.endswith(legacy_suffix):
+            symbols.add(name[:-len(legacy_suffix)])
+        elif os.path.isfile(os.path.join(bars_path, name, meta_file_name)):
+            symbols.add(name)
+    return sorted(symbols)
+
+def convert_legacy_bars(bars_path):
+    # Rewrites every legacy Data/<symbol>.pkl in the columnar format (the pickles are left in place)
+    for name in os.listdir(bars_path):
+        if name.endswith(legacy_suffix):
+            df = pd.read_pickle(os.path.join(bars_path, name))
+            df.datetime = pd.to_datetime(df.datetime)
+            write_bars(df.reset_index(drop=True), os.path.join(bars_path, name[:-len(legacy_suffix)]))
+
+#
+# Bars directory index
+#
+def bars_index_entry(path):
+    # Row count, date range and columns of a bars file, with the mtime they were read at
+    if is_legacy_bars_file(path):
+        bar_columns = read_bar_columns(path)
+        columns = list(bar_columns)
+        datetimes = bar_columns['datetime']
+    else:
+        columns = read_bar_meta(path)['columns']
+        datetimes = read_bar_columns(path, ['datetime'], mmap_mode='r')['datetime']
+    n_rows = len(datetimes)
+    return {'path': path, 'mtime': bars_mtime(path), 'n_rows': n_rows, 'columns': columns,
+            'start': str(pd.Timestamp(datetimes[0])) if n_rows > 0 else None,
+            'stop': str(pd.Timestamp(datetimes[-1])) if n_rows > 0 else None}
+
+def load_bars_index(bars_path):
+    # Returns {symbol: bars_index_entry} for every symbol in bars_path. The index is persisted in bars_path and only
+    # entries whose bars file has been rewritten since (by mtime) are read again, so an unchanged directory is
+    # indexed from a few stat calls without opening any bar file.
+    index_file = os.path.join(bars_path, bars_index_file_name)
+    try:
+        with open(index_file) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+
+    index = {}
+    for symbol in list_symbols(bars_path):
+        path = resolve_bars_file(bars_path, symbol)
+        entry = cached.get(symbol)
+        if (entry is None) or (entry['path'] != path) or (entry['mtime'] != bars_mtime(path)):
+            entry = bars_index_entry(path)
+        index[symbol] = entry
+
+    if index != cached:
+        tmp_file = f'{index_file}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file, index_file)
+    return index
+
+#
+# In-memory bar store
+#
+class BarStore():
+    # Columnar files are read through the meta.json snapshot taken when the store is loaded, so every column comes from
+    # the same version even if the bars are rewritten while the store is in use. If a file of that version has been
+    # removed since, the whole store is reloaded from the current version and generation is incremented (arrays taken
+    # from an earlier generation must not be mixed with new ones).
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path # String: path to a labeled bars file or columnar bars directory
+        self.mmap_mode = mmap_mode # 'r' memory-maps columnar files read-only so every process shares the same pages, None reads them into memory
+        self._lock = threading.RLock()
+        self.generation = -1
+        self._load()
+
+    def _load(self):
+        # mtime is read before meta.json, so a rewrite in between is seen as a newer version by get_bar_store
+        self.mtime = bars_mtime(self.path)
+        self.generation += 1
+
+        # Immutable numpy columns shared by every run (columnar files are mapped one column at a time on first use)
+        self.columns = {} # key=column name, value=read-only np.ndarray
+        if is_legacy_bars_file(self.path):
+            self.meta = None
+            for col, values in read_bar_columns(self.path).items():
+                self.columns[col] = self._freeze(values)
+        else:
+            self.meta = read_bar_meta(self.path) # Dictionary: meta.json of the version this store reads
+            self.columns['datetime'] = self._freeze(read_bar_columns(self.path, ['datetime'], self.mmap_mode, self.meta)['datetime'])
+        self.short_log_rets = None
+
+        self.n_bars = len(self.columns['datetime'])
+
+    def column_names(self):
+        return list(self.columns) if self.meta is None else list(self.meta['columns'])
+
+    def column(self, col, strategy_direction='Long'):
+        with self._lock:
+            if col not in self.columns:
+                try:
+                    values = read_bar_columns(self.path, [col], self.mmap_mode, self.meta)[col]
+                except FileNotFoundError: # this version has been replaced and cleaned up
+                    self._load()
+                    values = read_bar_columns(self.path, [col], self.mmap_mode, self.meta)[col]
+                self.columns[col] = self._freeze(values)
+
+            # Invert log_rets once for short selling strategies
+            if col == 'log_rets' and strategy_direction == 'Short':
+                if self.short_log_rets is None: self.short_log_rets = self._freeze(self.columns['log_rets'] * -1)
+                return self.short_log_rets
+            return self.columns[col]
+
+    def view(self, columns, strategy_direction='Long'):
+        # Returns a fresh DataFrame (datetime column, RangeIndex) over the requested columns only.
+        # Runs add their own columns to it, the shared arrays are never written to.
+        with self._lock:
+            while True:
+                generation = self.generation
+                frame = {col: self.column(col, strategy_direction) for col in columns}
+                if generation == self.generation: # no reload in between, every column is from the same version
+                    return pd.DataFrame({'datetime': self.columns['datetime'], **frame}, copy=False)
+
+    def _freeze(self, arr):
+        arr.setflags(write=False)
+        return arr
+
+def get_bar_store(path, mmap_mode='r'):
+    # Loads each bars file once per process and reloads it if the file has been rewritten since
+    with _bar_stores_lock:
+        store = _bar_stores.get(path)
+        if (store is None) or (store.mtime != bars_mtime(path)) or (store.mmap_mode != mmap_mode):
+            store = BarStore(path, mmap_mode)
+            _bar_stores[path] = store
+        return store
+
+def release_bar_store(path):
+    with _bar_stores_lock:
+        _bar_stores.pop(path, None)
+
+def clear_bar_stores():
+    with _bar_stores_lock:
+        _bar_stores.clear()
+
+#
+# Raw minute bar cache
+#
+class MinuteBarCache():
+    # Raw minute aggs, one structured .npy per symbol and day (<path>/<symbol>/<YYYY-MM-DD>.npy). Days without data
+    # are stored as empty arrays so closed market days are not requested again.
+    def __init__(self, path):
+        self.path = path # String: cache root directory
+
+    def day_file(self, symbol, day):
+        return os.path.join(self.path, symbol, f'{day.isoformat()}.npy')
+
+    def contains(self, symbol, day):
+        return os.path.isfile(self.day_file(symbol, day))
+
+    def read(self, symbol, day):
+        # Returns the day's structured records, or None if the day is not cached
+        day_file = self.day_file(symbol, day)
+        if not os.path.isfile(day_file):
+            return None
+        return np.load(day_file, allow_pickle=False)
+
+    def write(self, symbol, day, records):
+        os.makedirs(os.path.join(self.path, symbol), exist_ok=True)
+        day_file = self.day_file(symbol, day)
+        tmp_file = f'{day_file}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, np.ascontiguousarray(records), allow_pickle=False)
+        os.replace(tmp_file, day_file)
+
+    def days(self, symbol):
+        # Cached days of a symbol in date order
+        symbol_path = os.path.join(self.path, symbol)
+        if not os.path.isdir(symbol_path):
+            return []
+        return sorted(dt.date.fromisoformat(name[:-len('.npy')]) for name in os.listdir(symbol_path) if name.endswith('.npy'))
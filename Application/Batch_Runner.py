@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import pandas as pd
+
+import Simulation_Engine
+from Simulation_Engine import SimulationEngine, PortfolioSimulationEngine
+
+# Headless backtests: runs the sweep described by a JSON or YAML job file and writes the results to disk, without
+# PyQt5 or a display. Example job (YAML):
+#
+#   symbols: [AAPL, TSLA]
+#   portfolio: true                    # several symbols run as one portfolio, false tests each symbol alone
+#   direction: Long
+#   entry: ['open[] > close[]']
+#   exit: [friday]
+#   signal_params:                     # [param, base, max, step] rows, signals without rows are non-parametric
+#     'open[] > close[]': [[A, 1, 3, 1], [B, 2, null, null]]
+#   volatility: stdev_volatility
+#   pt_multiplier: {base: 1.0, delta: 0.5}   # base and 3 more steps of delta (a plain number keeps one value, null disables PT/SL)
+#   sl_multiplier: {base: 1.0, delta: 0.5}
+#   max_holding_bars: {base: 20, delta: 10}
+#   profitable_closes: {base: 3, delta: 1}
+#   n_jobs: -1
+#   top_k: 10                          # performance curves written for the best top_k results by Sharpe ratio
+#
+# Usage: python Batch_Runner.py job.yaml [job2.json ...] [--output DIR] [--bars-path DIR]
+result_columns = ['symbol', 'strategy_direction', 'num_trades', 'entry_params', 'exit_params', 'pt_mult', 'sl_mult',
+                  'maxhold', 'profitable_closes', 'sharpe_ratio', 'sortino_ratio']
+grid_keys = {'pt_multiplier': 'pt_mult_delta3', 'sl_multiplier': 'sl_mult_delta3',
+             'max_holding_bars': 'maxhold_delta3', 'profitable_closes': 'profitable_closes_delta3'}
+grid_types = {'pt_multiplier': float, 'sl_multiplier': float, 'max_holding_bars': int, 'profitable_closes': int}
+required_keys = ['symbols', 'direction', 'entry', 'volatility', 'max_holding_bars', 'profitable_closes']
+
+def load_job(job_file):
+    # Reads a job file, .yaml/.yml files need PyYAML
+    with open(job_file) as f:
+        if job_file.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('PyYAML is needed to read YAML job files (pip install pyyaml), or use a JSON job file')
+            return yaml.safe_load(f)
+        return json.load(f)
+
+def engine_from_job(job):
+    # Builds the SimulationEngine (one symbol, or several with portfolio: false) or PortfolioSimulationEngine of a job
+    missing = [key for key in required_keys if key not in job]
+    if len(missing) > 0:
+        raise ValueError(f'Job is missing {", ".join(missing)}')
+    if job['direction'] not in ('Long', 'Short'):
+        raise ValueError(f'direction must be Long or Short, not {job["direction"]}')
+
+    symbols = [job['symbols']] if isinstance(job['symbols'], str) else list(job['symbols'])
+    entry_checks = list(job['entry'])
+    exit_checks = list(job.get('exit', []))
+    signal_params = job.get('signal_params', {})
+    signals_and_params = {signal: [list(row) for row in signal_params.get(signal, [])] for signal in dict.fromkeys(entry_checks + exit_checks)}
+    non_parametric_checks = [signal for signal in entry_checks + exit_checks if len(signals_and_params[signal]) == 0]
+
+    grid = {}
+    for key, delta_key in grid_keys.items():
+        value = job.get(key)
+        if isinstance(value, dict): base, delta = value.get('base'), value.get('delta') or 0 # null delta keeps one value
+        else: base, delta = value, 0
+        grid[key] = None if base is None else grid_types[key](base)
+        grid[delta_key] = grid_types[key](delta)
+    if (grid['max_holding_bars'] is None) or (grid['profitable_closes'] is None):
+        raise ValueError('max_holding_bars and profitable_closes need a base value')
+
+    args = (entry_checks, exit_checks, non_parametric_checks, signals_and_params, job['volatility'],
+            grid['pt_multiplier'], grid['sl_multiplier'], grid['max_holding_bars'], grid['profitable_closes'],
+            grid['pt_mult_delta3'], grid['sl_mult_delta3'], grid['maxhold_delta3'], grid['profitable_closes_delta3'])
+    n_jobs = job.get('n_jobs', -1)
+    top_k = job.get('top_k', 0)
+    if (len(symbols) > 1) and job.get('portfolio', True):
+        return [PortfolioSimulationEngine(job['direction'], symbols, *args, n_jobs=n_jobs, top_k=top_k)]
+    return [SimulationEngine(job['direction'], symbol, *args, n_jobs=n_jobs, top_k=top_k) for symbol in symbols]
+
+def run_job(job, output_path):
+    # Runs a job and writes results.csv (one row per result), curves/rank_<n>.csv (the performance curves of the top_k
+    # results) and summary.json into output_path. Returns the databin.
+    t0 = time.perf_counter()
+    databin = []
+    for engine in engine_from_job(job):
+        def report_progress(n_done, n_tasks):
+            if (n_done * 10) // n_tasks > ((n_done - 1) * 10) // n_tasks: # every 10% of the grid points
+                print(f'{n_done}/{n_tasks} grid points, {time.perf_counter() - t0:.1f}s')
+        databin.extend(engine.Simulate(progress_callback=report_progress))
+    elapsed = time.perf_counter() - t0
+
+    os.makedirs(output_path, exist_ok=True)
+    results = pd.DataFrame([[getattr(result, col) for col in result_columns] for result in databin], columns=result_columns)
+    results.to_csv(os.path.join(output_path, 'results.csv'), index=False)
+
+    ranked = sorted((result for result in databin if result.performance_curve is not None), key=lambda result: result.sort_key(), reverse=True)
+    if len(ranked) > 0:
+        os.makedirs(os.path.join(output_path, 'curves'), exist_ok=True)
+    for rank, result in enumerate(ranked, start=1):
+        result.performance_curve.rename('performance_curve').to_csv(os.path.join(output_path, 'curves', f'rank_{rank}.csv'))
+
+    summary = {'job': job, 'n_results': len(databin), 'seconds': round(elapsed, 3), 'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+    with open(os.path.join(output_path, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    print(f'{len(databin)} results in {elapsed:.1f}s, written to {output_path}')
+    return databin
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run backtest sweeps from JSON/YAML job files without the GUI')
+    parser.add_argument('job_files', nargs='+')
+    parser.add_argument('--output', default=None, help='results directory (default: <job file>_results next to the job file, one per job)')
+    parser.add_argument('--bars-path', default=None, help='directory with the labeled bars (default: Simulation_Engine.labeled_bars_path)')
+    args = parser.parse_args(argv)
+
+    if args.bars_path is not None: Simulation_Engine.labeled_bars_path = args.bars_path
+    for job_file in args.job_files:
+        job = load_job(job_file)
+        if args.output is None: output_path = f'{os.path.splitext(job_file)[0]}_results'
+        elif len(args.job_files) == 1: output_path = args.output
+        else: output_path = os.path.join(args.output, os.path.splitext(os.path.basename(job_file))[0])
+        print(f'Running {job_file}')
+        run_job(job, output_path)
+
+if __name__ == '__main__':
+    sys.exit(main())
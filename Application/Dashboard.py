@@ -4,28 +4,34 @@ Created on Sun Nov 21 03:23:50 2021
 
 @author: 14843
 """
-import os
+import time
+startup_t0 = time.perf_counter() # cold start is measured from here to the first pass of the event loop
+
 import sys
+import threading
 import webbrowser
+from collections import OrderedDict
 
 from PyQt5 import QtCore, QtWidgets
-from PyQt5.QtWidgets import QTableWidgetItem, QStyledItemDelegate, QComboBox, QMessageBox, QRadioButton, QButtonGroup, QWidget
-from PyQt5.QtCore import Qt, QAbstractTableModel
+from PyQt5.QtWidgets import QTableWidgetItem, QStyledItemDelegate, QComboBox, QMessageBox, QCheckBox, QWidget, QProgressBar, QPushButton, QSpinBox
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QThread, pyqtSignal
 
 import numpy as np
 import pandas as pd
 
-import matplotlib as plt
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
-
 from mainwindow import Ui_Toolbox
 from strategyoutputwindow import Ui_StrategyOutputWindow
 
-from Data_Downloader import DataDownloader
-from Simulation_Engine import SimulationEngine
+# matplotlib, Data_Downloader (requests, joblib) and Simulation_Engine are imported when the tab that needs them is used
+from Bar_Store import get_bar_store, load_bars_index
+from Feature_Engine import parse_volatility_column
 
 repo_path = 'C:\\Users\\14843\\Documents\\GitHub\\Trading-Strategy-Simulator'
 bars_path = f'{repo_path}\\Data'
+startup_log_file = f'{repo_path}\\startup_times.csv' # One line per cold start: timestamp, seconds
+simulation_n_jobs = -1 # Worker processes used for parameter sweeps (1 = serial, -1 = all cores)
+table_fetch_rows = 1000 # Rows added to a table model each time its view scrolls to the end
+table_cell_cache_size = 1 << 14 # Formatted cells kept per table model
 
 #############################################
 
@@ -57,8 +63,6 @@ parameters_dict = {'monday': None,
                    'open[] <= low[]': ('A', 'B'),
                    'open[] <= close[]': ('A', 'B')}
 
-labeled_bars_bin = os.listdir(bars_path)
-
 #############################################
 
 class MyWindow(QtWidgets.QMainWindow):
@@ -67,15 +71,42 @@ class MyWindow(QtWidgets.QMainWindow):
         self.ui = Ui_Toolbox()
         self.ui.setupUi(self)
 
+        # Symbols, row counts, date ranges and columns of the bars in Data (see Bar_Store.load_bars_index)
+        self.bars_index = load_bars_index(bars_path)
+
         # Instantiating strategyoutputwindow class 
         self.StrategyOutput_Ui = Ui_StrategyOutputWindow()
         self.StrategyOutputWindow = QtWidgets.QMainWindow()
         self.StrategyOutput_Ui.setupUi(self.StrategyOutputWindow)
+        self.strategy_output_model = StrategyOutputModel()
+        self.StrategyOutput_Ui.StrategyOutput_tableview.setModel(self.strategy_output_model)
+        self.StrategyOutput_Ui.StrategyOutput_tableview.sortByColumn(StrategyOutputModel.default_sort_column, Qt.DescendingOrder)
+
+        # Top K filter of the strategy output (by the sorted column, 0 shows every row)
+        self.topk_spinbox = QSpinBox()
+        self.topk_spinbox.setRange(0, 1 << 30)
+        self.topk_spinbox.setPrefix('Top ')
+        self.topk_spinbox.setSpecialValueText('All rows')
+        self.topk_spinbox.valueChanged.connect(self.strategy_output_model.setTopK)
+        self.StrategyOutput_Ui.statusbar.addPermanentWidget(self.topk_spinbox)
 
         # For storing signal parameters in memory
         self.tempkey = ''
         self.ParamTableData = {}
 
+        # Background tests and downloads (one at a time), with progress and a cancel button in the status bar
+        self.worker = None
+        self.worker_start = 0.0
+        self.databin = []
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumWidth(200)
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.clicked.connect(self.CancelBtn_Clicked)
+        self.ui.statusbar.addPermanentWidget(self.progress_bar)
+        self.ui.statusbar.addPermanentWidget(self.cancel_button)
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+
         # Data Viewer Tab
         self.fillComboBox()
 
@@ -83,6 +114,7 @@ class MyWindow(QtWidgets.QMainWindow):
         self.prepareSymbolBin()
         self.prepareSignalBin()
         self.prepareSignalParameterTable()
+        self.fillVolCalculationComboBox()
         
         # Passive methods
         self.ui.SignalBin.selectionModel().selectionChanged.connect(self.on_signalbin_selectionChange)
@@ -126,14 +158,21 @@ class MyWindow(QtWidgets.QMainWindow):
             error = 'Set an end time'
             self.Error_Popup(error)
         if error is None:
-            DataDownloader(symbols, start, stop).download_data()
+            if self._workerRunning():
+                return
+            self._startWorker(DownloadWorker(symbols, start, stop), 'Downloading')
+            self.worker.progress.connect(self.onDownloadProgress)
+            self.worker.start()
 
     # Strategy Simulator Tab
     def TestBtn_Clicked(self):
         self._storeSignalParams()
 
-        # Get symbol
-        symbol = self._retrieveSymbolCheck()
+        # Get symbols
+        symbols = self._retrieveSymbolCheck()
+        if len(symbols) == 0:
+            self.Error_Popup('Select at least 1 symbol')
+            return
 
         # Get SignalBin selections
         entry_checks, exit_checks, non_parametric_checks = self._retrieveSignalBinSelections()
@@ -161,6 +200,13 @@ class MyWindow(QtWidgets.QMainWindow):
             strategy_direction = self.ui.StrategyDirection_Input.currentText()
         if len(self.ui.VolCalculation_Input.currentText()) > 0:
             volatility_calculation = self.ui.VolCalculation_Input.currentText()
+
+        # Stored volatility features are listed for any symbol, every checked symbol needs the chosen one
+        if (volatility_calculation is not None) and (parse_volatility_column(volatility_calculation) is not None):
+            missing = [symbol for symbol in symbols if volatility_calculation not in self.bars_index[symbol]['columns']]
+            if len(missing) > 0:
+                self.Error_Popup(f'{volatility_calculation} is not stored for {", ".join(missing)}')
+                return
         
         # Get line edit inputs
         pt_multiplier = None
@@ -207,17 +253,68 @@ class MyWindow(QtWidgets.QMainWindow):
         try: profitable_closes_delta3 = int(profitable_closes_delta3)
         except: profitable_closes_delta3 = None
 
-        # Run test and retrieve databin
-        databin = SimulationEngine(strategy_direction, symbol, entry_checks, exit_checks, non_parametric_checks, signals_and_params,
-                                volatility_calculation, pt_multiplier, sl_multiplier, max_holding_bars, profitable_closes,
-                                pt_mult_delta3, sl_mult_delta3, maxhold_delta3, profitable_closes_delta3).Simulate()
-
-        # Prepare strategy output table
-        self.prepareStrategyOutputTable(databin)
-
-        # Show strategy output window
+        # Run test in the background (several symbols run as a portfolio)
+        if self._workerRunning():
+            return
+        from Simulation_Engine import SimulationEngine, PortfolioSimulationEngine
+        if len(symbols) == 1: engine = SimulationEngine
+        else: engine = PortfolioSimulationEngine
+        engine = engine(strategy_direction, symbols[0] if len(symbols) == 1 else symbols, entry_checks, exit_checks, non_parametric_checks, signals_and_params,
+                        volatility_calculation, pt_multiplier, sl_multiplier, max_holding_bars, profitable_closes,
+                        pt_mult_delta3, sl_mult_delta3, maxhold_delta3, profitable_closes_delta3, n_jobs=simulation_n_jobs)
+
+        # Prepare an empty strategy output table, results are appended as they finish
+        self.databin = []
+        self.prepareStrategyOutputTable(self.databin)
         self.StrategyOutputWindow.show()
 
+        self._startWorker(SimulationWorker(engine), 'Testing')
+        self.worker.results_ready.connect(self.appendStrategyOutputRows)
+        self.worker.progress.connect(self.onTestProgress)
+        self.worker.start()
+
+    # Background tasks
+    def CancelBtn_Clicked(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.cancel_button.setEnabled(False)
+            self.ui.statusbar.showMessage(f'{self.worker.name}: cancelling...')
+
+    # Background tasks
+    def onTestProgress(self, n_done, n_tasks):
+        self.progress_bar.setRange(0, n_tasks)
+        self.progress_bar.setValue(n_done)
+        self.ui.statusbar.showMessage(f'Testing: {n_done}/{n_tasks} grid points, ETA {self._eta(n_done, n_tasks)}')
+
+    # Background tasks
+    def onDownloadProgress(self, symbol, stage, count, total, detail):
+        self.ui.statusbar.showMessage(f'Downloading {symbol}: {stage} ({count}/{total}) {detail}'.rstrip())
+        if stage == 'built':
+            self.progress_bar.setRange(0, total)
+            self.progress_bar.setValue(count)
+
+    # Background tasks
+    def onWorkerFinished(self):
+        # QThread.finished is emitted from the thread just before it ends, wait() lets it end before it's dropped
+        worker = self.worker
+        worker.wait()
+        self.worker = None
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+        if worker.error is not None:
+            self.ui.statusbar.showMessage(f'{worker.name} failed')
+            self.Error_Popup(worker.error)
+            return
+        if isinstance(worker, SimulationWorker) and worker.databin is not None:
+            self.databin = worker.databin # ordered by signal parameter combination, then by grid point
+        if isinstance(worker, DownloadWorker): # new or updated bars
+            self.bars_index = load_bars_index(bars_path)
+            self.fillComboBox()
+            self.prepareSymbolBin()
+            self.fillVolCalculationComboBox()
+        status = 'cancelled' if worker.cancel_event.is_set() else 'finished'
+        self.ui.statusbar.showMessage(f'{worker.name} {status} after {time.perf_counter() - self.worker_start:.1f}s')
+
     # Strategy Simulator Tab
     def on_signalbin_selectionChange(self, selected, deselected):
         self._storeSignalParams()
@@ -271,39 +368,45 @@ class MyWindow(QtWidgets.QMainWindow):
     # Data Viewer Tab
     def fillComboBox(self):
         self.ui.comboBox.clear()
-        for file in labeled_bars_bin:
+        for file in self.bars_index:
             self.ui.comboBox.addItem(file)
 
     # Data Viewer Tab
     def onRefresh(self):
         file_name = self.ui.comboBox.currentText()
-        df = pd.read_pickle(bars_path + '\\' + file_name)
 
-        model = PandasModel(df)
+        # Columns are loaded when they are first painted
+        model = BarsFileModel(self.bars_index[file_name]['path'])
         self.ui.tableView.setModel(model)
 
     # Strategy Simulator Tab
     def prepareSymbolBin(self):
-        self.ui.Symbol_tablewidget.setRowCount(len(labeled_bars_bin))
+        self.ui.Symbol_tablewidget.setRowCount(len(self.bars_index))
         self.ui.Symbol_tablewidget.setColumnCount(2) # len([symbol, select])
         self.ui.Symbol_tablewidget.setHorizontalHeaderLabels(('Symbol', 'Select'))
 
-        button_group = QButtonGroup(self)
-        button_group.setExclusive(True)
-
-        for row, symbol in enumerate(labeled_bars_bin):
+        # Checking several symbols runs the strategy as a portfolio
+        for row, symbol in enumerate(self.bars_index):
             for col in range(2):
                 if col == 0:
                     self.ui.Symbol_tablewidget.setItem(row, col, QTableWidgetItem(symbol))
                 else:
-                    radiobutton = QRadioButton()
-                    button_group.addButton(radiobutton)
-                    self.ui.Symbol_tablewidget.setCellWidget(row, col, radiobutton)
+                    checkbox = QCheckBox()
+                    self.ui.Symbol_tablewidget.setCellWidget(row, col, checkbox)
         
         # Set 'Symbol' column to read only
         delegate = ReadOnlyDelegate(self)
         self.ui.Symbol_tablewidget.setItemDelegateForColumn(0, delegate)
 
+    # Strategy Simulator Tab
+    def fillVolCalculationComboBox(self):
+        # Adds the pipeline volatility features (see Feature_Engine) stored for any symbol
+        stored = set()
+        for entry in self.bars_index.values():
+            stored.update(col for col in entry['columns'] if parse_volatility_column(col) is not None)
+        for col in sorted(stored):
+            if self.ui.VolCalculation_Input.findText(col) < 0: self.ui.VolCalculation_Input.addItem(col)
+
     # Strategy Simulator Tab
     def prepareSignalBin(self):
         col_names = tuple(['Signal', 'Type', '*Entry', 'Exit'])
@@ -341,18 +444,38 @@ class MyWindow(QtWidgets.QMainWindow):
 
     # Strategy Output Window
     def prepareStrategyOutputTable(self, databin):
-        col_names = tuple(['Symbol', 'Direction', '# Trades', 'Entry Params', 'Exit Params', 'Sharpe Ratio', 'Sortino Ratio']) # Add later: [psr, dsr]
-        n_cols = len(col_names)
-        n_rows = len(databin)
-        self.StrategyOutput_Ui.StrategyOutput_tablewidget.setRowCount(n_rows)
-        self.StrategyOutput_Ui.StrategyOutput_tablewidget.setColumnCount(n_cols)
-        self.StrategyOutput_Ui.StrategyOutput_tablewidget.setHorizontalHeaderLabels(col_names)
-        
-        for row, contents in enumerate(databin):
-            dataset = contents[0]
-            bin = contents[1]
-            for col, item in enumerate(bin):
-                self.StrategyOutput_Ui.StrategyOutput_tablewidget.setItem(row, col, QTableWidgetItem(item)) 
+        self.strategy_output_model.clear()
+        self.strategy_output_model.append(databin)
+
+    # Strategy Output Window
+    def appendStrategyOutputRows(self, results):
+        self.strategy_output_model.append(results)
+
+    # Background tasks (helper func)
+    def _workerRunning(self):
+        if self.worker is not None:
+            self.Error_Popup(f'{self.worker.name} is still running')
+            return True
+        return False
+
+    # Background tasks (helper func)
+    def _startWorker(self, worker, name):
+        worker.name = name
+        worker.finished.connect(self.onWorkerFinished)
+        self.worker = worker
+        self.worker_start = time.perf_counter()
+        self.progress_bar.setRange(0, 0) # busy until the first progress report
+        self.progress_bar.show()
+        self.cancel_button.setEnabled(True)
+        self.cancel_button.show()
+        self.ui.statusbar.showMessage(f'{name}...')
+
+    # Background tasks (helper func)
+    def _eta(self, n_done, n_total):
+        if n_done == 0:
+            return '?'
+        seconds = int((time.perf_counter() - self.worker_start) / n_done * (n_total - n_done))
+        return f'{seconds // 60}m {seconds % 60:02d}s'
 
     # Strategy Simulator Tab (helper func)
     def _readParamTableData_from_memory(self):
@@ -366,11 +489,13 @@ class MyWindow(QtWidgets.QMainWindow):
 
     # Strategy Simulator Tab (helper func)
     def _retrieveSymbolCheck(self):
+        symbols = []
         for row in range(self.ui.Symbol_tablewidget.rowCount()):
             for col in range(self.ui.Symbol_tablewidget.columnCount()):
                 if col == 1:
                     if self.ui.Symbol_tablewidget.cellWidget(row, col).isChecked():
-                        return self.ui.Symbol_tablewidget.item(row, 0).text() # return checked symbols
+                        symbols.append(self.ui.Symbol_tablewidget.item(row, 0).text())
+        return symbols # return checked symbols
     
     # Strategy Simulator Tab (helper func)
     def _retrieveSignalBinSelections(self):
@@ -420,54 +545,326 @@ class checkableComboBox(QComboBox):
         super().__init__()
         self._changed = False
 
-class PandasModel(QAbstractTableModel):
+class SimulationWorker(QThread):
+    # Runs a (Portfolio)SimulationEngine sweep off the GUI thread. Signals are delivered on the GUI thread.
+    results_ready = pyqtSignal(list) # SimulationResults of one finished task
+    progress = pyqtSignal(int, int) # finished tasks, total tasks
+
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+        self.cancel_event = threading.Event()
+        self.databin = None
+        self.error = None
+        self.name = 'Test'
+
+    def run(self):
+        try:
+            self.databin = self.engine.Simulate(self.results_ready.emit, self.progress.emit, self.cancel_event)
+        except Exception as e:
+            self.error = f'Test failed: {e!r}'
+
+    def cancel(self):
+        self.cancel_event.set()
+
+class DownloadWorker(QThread):
+    # Runs DataDownloader.download_data off the GUI thread. A cancelled download stops before the next symbol is built.
+    progress = pyqtSignal(str, str, int, int, str) # symbol, stage, count, total, detail
+
+    def __init__(self, symbols, start, stop):
+        super().__init__()
+        from Data_Downloader import DataDownloader
+        self.cancel_event = threading.Event()
+        self.downloader = DataDownloader(symbols, start, stop, progress_callback=self.progress.emit, cancel_event=self.cancel_event)
+        self.error = None
+        self.name = 'Download'
+
+    def run(self):
+        try:
+            self.downloader.download_data()
+        except Exception as e:
+            self.error = f'Download failed: {e!r}'
+
+    def cancel(self):
+        self.cancel_event.set()
+
+class StrategyOutputModel(QAbstractTableModel):
+    # Strategy output over SimulationResults. Numeric columns sort on a typed record array (SimulationResult.to_records),
+    # self._order holds every row in sorted order and the view shows its first self._n_rows (cut to top_k). Appended
+    # results are inserted at their sorted positions (np.searchsorted on self._keys) so the view keeps its scroll
+    # position and selection, and cell text is only built for painted cells.
+    col_names = ('Symbol', 'Direction', '# Trades', 'Entry Params', 'Exit Params', 'Sharpe Ratio', 'Sortino Ratio') # Add later: [psr, dsr]
+    col_fields = ('symbol', 'strategy_direction', 'num_trades', 'entry_params', 'exit_params', 'sharpe_ratio', 'sortino_ratio')
+    default_sort_column = 5 # Sharpe Ratio
+
+    def __init__(self):
+        QAbstractTableModel.__init__(self)
+        self._sort_column = None # None keeps arrival order
+        self._sort_order = Qt.DescendingOrder
+        self._top_k = 0 # 0 shows every row
+        self.clear()
+
+    def clear(self):
+        # Drops every result, the sort column and top_k are kept
+        self.beginResetModel()
+        self._results = [] # List of SimulationResults in arrival order
+        self._records = None # Numeric fields of self._results (SimulationResult.to_records), capacity grows by doubling
+        self._order = np.empty(0, dtype=np.int64) # Indices into self._results in sorted order
+        self._keys = None # Sort keys of self._order (see _sortKeys), None in arrival order
+        self._n_rows = 0 # Rows shown, the first ones of self._order
+        self.endResetModel()
+
+    def append(self, results):
+        if len(results) == 0: return
+        n_old = len(self._results)
+        n_new = n_old + len(results)
+        new_records = type(results[0]).to_records(results)
+        if self._records is None: self._records = np.empty(0, dtype=new_records.dtype)
+        if n_new > len(self._records):
+            records = np.empty(max(n_new, 2 * len(self._records)), dtype=new_records.dtype)
+            records[:n_old] = self._records[:n_old]
+            self._records = records
+        self._records[n_old:n_new] = new_records
+        self._results.extend(results)
+        if n_old == 0:
+            self._refresh()
+            return
+
+        rows = np.arange(n_old, n_new)
+        keys = self._sortKeys(n_old, n_new)
+        if keys is None: # arrival order, new rows go last
+            positions = np.full(len(rows), n_old)
+        else:
+            batch_order = self._sortedOrder(keys)
+            rows, keys = rows[batch_order], keys[batch_order]
+            if self._reversed_keys: # self._keys is descending, search its ascending view
+                positions = n_old - np.searchsorted(self._keys[::-1], keys, side='right')
+            else: # after equal keys, like the stable sort in _refresh
+                positions = np.searchsorted(self._keys, keys, side='right')
+            self._keys = np.insert(self._keys, positions, keys)
+        self._order = np.insert(self._order, positions, rows)
+
+        # Inserted rows in their final positions, each run of adjacent rows is one insertion. Runs past the shown rows
+        # are not shown and the rows pushed past top_k are removed at the end.
+        new_rows = positions + np.arange(len(positions))
+        limit = self._rowLimit()
+        for run in np.split(new_rows, np.flatnonzero(np.diff(new_rows) != 1) + 1):
+            first = int(run[0])
+            if (first >= limit) or (first > self._n_rows): break
+            self.beginInsertRows(QModelIndex(), first, first + len(run) - 1)
+            self._n_rows += len(run)
+            self.endInsertRows()
+        self._setRowCount(limit)
+
+    def setTopK(self, top_k):
+        self._top_k = top_k
+        self._setRowCount(self._rowLimit())
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self._sort_column = column
+        self._sort_order = order
+        self._refresh()
+
+    @property
+    def _reversed_keys(self):
+        # Text columns can't be negated, their keys are kept in descending order instead
+        return (self._sort_order == Qt.DescendingOrder) and (self.col_fields[self._sort_column] not in self._records.dtype.names)
+
+    def _sortKeys(self, start, stop):
+        # Sort keys of results[start:stop], None in arrival order. Numeric keys are floats (negated for descending, nan
+        # last in both orders), text keys an object array.
+        if self._sort_column is None: return None
+        field = self.col_fields[self._sort_column]
+        if field in self._records.dtype.names:
+            keys = self._records[field][start:stop].astype(np.float64)
+            return -keys if self._sort_order == Qt.DescendingOrder else keys
+        return np.array([getattr(result, field) for result in self._results[start:stop]], dtype=object)
+
+    def _sortedOrder(self, keys):
+        order = np.argsort(keys, kind='stable')
+        return order[::-1] if self._reversed_keys else order
+
+    def _rowLimit(self):
+        return len(self._order) if self._top_k == 0 else min(len(self._order), self._top_k)
+
+    def _setRowCount(self, n_rows):
+        # Shows the first n_rows of self._order
+        if n_rows > self._n_rows:
+            self.beginInsertRows(QModelIndex(), self._n_rows, n_rows - 1)
+            self._n_rows = n_rows
+            self.endInsertRows()
+        elif n_rows < self._n_rows:
+            self.beginRemoveRows(QModelIndex(), n_rows, self._n_rows - 1)
+            self._n_rows = n_rows
+            self.endRemoveRows()
+
+    def _refresh(self):
+        self.beginResetModel()
+        n = len(self._results)
+        keys = None if n == 0 else self._sortKeys(0, n)
+        if keys is None:
+            self._order = np.arange(n)
+            self._keys = None
+        else:
+            self._order = self._sortedOrder(keys)
+            self._keys = keys[self._order]
+        self._n_rows = self._rowLimit()
+        self.endResetModel()
+
+    def result(self, row):
+        return self._results[self._order[row]]
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid(): return 0
+        return self._n_rows
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid(): return 0
+        return len(self.col_names)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if index.isValid():
+            if role == Qt.DisplayRole:
+                return str(getattr(self.result(index.row()), self.col_fields[index.column()]))
+        return None
+
+    def headerData(self, col, orientation, role):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.col_names[col]
+        return None
 
+class PandasModel(QAbstractTableModel):
+    # Table model over numpy columns. The view gets table_fetch_rows more rows each time it scrolls to the end
+    # (canFetchMore/fetchMore) and cells are formatted when they are first painted, then kept in a small LRU cache.
     def __init__(self, data):
         QAbstractTableModel.__init__(self)
-        self._data = data
+        self._setColumns(list(data.columns), len(data))
+        self._arrays = {col: data[col].to_numpy() for col in self._columns}
+
+    def _setColumns(self, columns, n_rows):
+        self._columns = columns # List of column names
+        self._arrays = {} # key=column name, value=np.ndarray
+        self._n_rows = n_rows
+        self._n_fetched_rows = min(n_rows, table_fetch_rows)
+        self._cell_cache = OrderedDict() # key=(row, col), value=String
+
+    def _columnArray(self, col):
+        return self._arrays[self._columns[col]]
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid(): return 0
+        return self._n_fetched_rows
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid(): return 0
+        return len(self._columns)
 
-    def rowCount(self, parent=None):
-        return self._data.shape[0]
+    def canFetchMore(self, parent):
+        return (not parent.isValid()) and (self._n_fetched_rows < self._n_rows)
 
-    def columnCount(self, parnet=None):
-        return self._data.shape[1]
+    def fetchMore(self, parent):
+        if parent.isValid(): return
+        n_rows = min(table_fetch_rows, self._n_rows - self._n_fetched_rows)
+        self.beginInsertRows(QModelIndex(), self._n_fetched_rows, self._n_fetched_rows + n_rows - 1)
+        self._n_fetched_rows += n_rows
+        self.endInsertRows()
 
     def data(self, index, role=Qt.DisplayRole):
         if index.isValid():
             if role == Qt.DisplayRole:
-                return str(self._data.iloc[index.row(), index.column()])
+                key = (index.row(), index.column())
+                text = self._cell_cache.get(key)
+                if text is None:
+                    values = self._columnArray(index.column())
+                    if values is None: return None
+                    text = self._format(values[index.row()])
+                    self._cell_cache[key] = text
+                    if len(self._cell_cache) > table_cell_cache_size: self._cell_cache.popitem(last=False)
+                else:
+                    self._cell_cache.move_to_end(key)
+                return text
         return None
 
     def headerData(self, col, orientation, role):
         if orientation == Qt.Horizontal and role == Qt.DisplayRole:
-            return self._data.columns[col]
+            return self._columns[col]
         return None
 
-class Canvas(FigureCanvasQTAgg):
-    def __init__(self, parent):
-        fig, self.ax = plt.subplots(figsize=(5,4), dpi=200)
-        super().__init__(fig)
-        self.setParent(parent)
-
-        t = np.arrange(0.0, 2.0, 0.01)
-        s = 1 + np.sin(2 * np.pi * t)
-
-        self.ax.plot(t, s)
-        self.ax.set(xlabel='X-axis', ylabel='Y-axis', title='Title')
-        self.ax.grid()
+    def _format(self, value):
+        # Same text as str() of the pandas cell
+        if isinstance(value, np.datetime64): return str(pd.Timestamp(value))
+        return str(value)
+
+class BarsFileModel(PandasModel):
+    # PandasModel over a bars file. Columns come from the process's bar store (memory-mapped for columnar files)
+    # the first time the view paints one of their cells, so hidden columns are never read. The store keeps reading the
+    # version the model was opened on; if that version is cleaned up after a rewrite the store reloads and the model
+    # resets itself to the new version.
+    def __init__(self, bars_file):
+        QAbstractTableModel.__init__(self)
+        self._store = get_bar_store(bars_file)
+        self._generation = self._store.generation
+        self._setColumns(self._store.column_names(), self._store.n_bars)
+
+    def _columnArray(self, col):
+        name = self._columns[col]
+        if name not in self._arrays:
+            values = self._store.column(name)
+            if self._store.generation != self._generation: # the store moved to a newer version
+                QtCore.QTimer.singleShot(0, self._reload)
+                return None
+            self._arrays[name] = values
+        return self._arrays[name]
+
+    def _reload(self):
+        if self._generation == self._store.generation: return
+        self.beginResetModel()
+        self._generation = self._store.generation
+        self._setColumns(self._store.column_names(), self._store.n_bars)
+        self.endResetModel()
+
+def make_canvas(parent):
+    # matplotlib is only imported once a chart is opened
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
+
+    fig, ax = plt.subplots(figsize=(5,4), dpi=200)
+    canvas = FigureCanvasQTAgg(fig)
+    canvas.setParent(parent)
+
+    t = np.arange(0.0, 2.0, 0.01)
+    s = 1 + np.sin(2 * np.pi * t)
+
+    ax.plot(t, s)
+    ax.set(xlabel='X-axis', ylabel='Y-axis', title='Title')
+    ax.grid()
+    return canvas
 
 class CanvasWindow(QWidget):
     def __init__(self):
         super().__init__()
         self.resize(900, 900)
 
-        chart = Canvas(self)
+        chart = make_canvas(self)
 
 ###########################
+def log_startup_time():
+    # Cold start: module import to the first pass of the event loop (the window has been shown). Every start is
+    # appended to startup_log_file so regressions show up.
+    seconds = time.perf_counter() - startup_t0
+    print(f'Started in {seconds:.2f}s')
+    try:
+        with open(startup_log_file, 'a') as f:
+            f.write(f'{time.strftime("%Y-%m-%d %H:%M:%S")},{seconds:.3f}\n')
+    except OSError:
+        pass
+
 def open_app():
     app = QtWidgets.QApplication(sys.argv)
     win = MyWindow()
     win.show()
+    QtCore.QTimer.singleShot(0, log_startup_time)
     sys.exit(app.exec_())
 
-open_app() # Run application
+if __name__ == '__main__':
+    open_app() # Run application
@@ -1,17 +1,20 @@
 import os
 import time
+import threading
 import datetime as dt
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
-from pathlib import Path
-from joblib import Parallel, delayed
+from Bar_Store import write_bars, read_bars, meta_file_name, MinuteBarCache
+from Bar_Sampler import BarSampler, DollarBarRule, bar_sampling_rules, daily_thresholds, build_threshold_bars
+from Feature_Engine import rolling_mean_absolute_deviation, label_volatility_features, parse_volatility_column, update_bar_features
 
 repo_path = 'C:\\Users\\14843\\Documents\\GitHub\\Trading-Strategy-Simulator'
 apikey = '' # I use a paid polygon.io key
@@ -19,101 +22,417 @@ apikey = '' # I use a paid polygon.io key
 #############################################
 
 estimation_window = 50
+threshold_window = 60 # Trading days in the rolling mean daily dollar value behind the dollar bar thresholds
+minute_cache_dir = 'minute_bars' # Raw minute bar cache inside Data (see Bar_Store.MinuteBarCache)
+daily_dollar_values_dir = 'daily_dollar_values' # Stored inside each symbol's bars directory for incremental updates
+build_chunk_days = 20 # Days of minute bars per parallel task in build_dollar_bars
+sampler_chunk_minutes = 1 << 18 # Minute bars per chunk fed to the streaming bar samplers
+sampler_chunk_days = 20 # Cached days per chunk when sampling from the minute bar cache
+default_volatility_features = {} # Extra volatility features stored with every download (see Feature_Engine), e.g. {'atr': [14, 50], 'ewm_stdev': [20, 50]}
+
+# polygon.io aggs endpoint, url{} = base_url, ticker, date, date, apikey
+polygon_base_url = 'https://api.polygon.io'
+polygon_aggs_url = '{}/v2/aggs/ticker/{}/range/1/minute/{}/{}?adjusted=true&sort=asc&limit=1440&apiKey={}'
+
+max_concurrent_requests = 8 # Day requests in flight per symbol
+max_requests_per_second = None # Match the polygon.io plan (e.g. 5 / 60 for the free plan), None = no limit
+max_symbol_prefetch_default = 2 # Symbols fetched while the previous one is being built (network and memory bound, not CPU)
+request_retries = 3 # Retries per day request on connection errors (HTTP 429/5xx are retried by the session)
+market_timezone = ZoneInfo('America/New_York')
+session_close_time = dt.time(20, 0) # End of the extended hours session (ET), a day's minute bars are final after it
+
+def is_finished_day(day):
+    # True once the day's session has closed in New York, its minute bars can't change anymore
+    return dt.datetime.now(market_timezone) >= dt.datetime.combine(day, session_close_time, tzinfo=market_timezone)
+
+class RateLimiter():
+    # Spaces request starts at least 1 / requests_per_second apart across all threads
+    def __init__(self, requests_per_second):
+        self.interval = 0.0 if requests_per_second is None else 1.0 / requests_per_second
+        self.next_request_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.interval == 0.0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_request_time - now
+            self.next_request_time = max(now, self.next_request_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+class MinuteBarAccumulator():
+    # Collects polygon aggs records into growable typed numpy buffers (doubling capacity when full), so
+    # appending a day costs O(day) instead of re-copying everything accumulated so far
+    record_fields = {'t': np.int64, 'o': np.float64, 'h': np.float64, 'l': np.float64, 'c': np.float64, 'v': np.float64, 'n': np.float64}
+    column_names = {'o': 'open', 'h': 'high', 'l': 'low', 'c': 'close', 'v': 'volume', 'n': 'trades'}
+
+    def __init__(self, capacity=1 << 16):
+        self.size = 0
+        self.buffers = {field: np.empty(capacity, dtype=dtype) for field, dtype in self.record_fields.items()}
+
+    record_dtype = np.dtype(list(record_fields.items()))
+
+    @classmethod
+    def to_records(cls, results):
+        # Converts a day's list of aggs dicts into a structured array (the format kept in the minute bar cache)
+        n = len(results)
+        records = np.empty(n, dtype=cls.record_dtype)
+        for field, dtype in cls.record_fields.items():
+            missing = 0 if field == 't' else np.nan
+            records[field] = np.fromiter((r.get(field, missing) for r in results), dtype=dtype, count=n)
+        return records
+
+    def append(self, records):
+        n = len(records)
+        if self.size + n > len(self.buffers['t']):
+            self._grow(self.size + n)
+        for field in self.record_fields:
+            self.buffers[field][self.size:self.size + n] = records[field]
+        self.size += n
+
+    def to_frame(self):
+        # Minute bars indexed by datetime with the columns build_dollar_bars expects
+        minute_bars = pd.DataFrame({self.column_names[field]: self.buffers[field][:self.size] for field in self.column_names},
+                                   index=pd.DatetimeIndex(pd.to_datetime(self.buffers['t'][:self.size], unit='ms').astype('datetime64[ns]'), name='datetime'))
+        return minute_bars[['open', 'high', 'low', 'close', 'volume', 'trades']]
+
+    def _grow(self, min_capacity):
+        capacity = max(min_capacity, 2 * len(self.buffers['t']))
+        for field, buffer in self.buffers.items():
+            grown = np.empty(capacity, dtype=buffer.dtype)
+            grown[:self.size] = buffer[:self.size]
+            self.buffers[field] = grown
 
 class DataDownloader():
-    def __init__(self, symbols, start, stop):
+    def __init__(self, symbols, start, stop, max_workers=None, requests_per_second=None, base_url=None, incremental=False,
+                 volatility_features=None, max_symbol_prefetch=None, progress_callback=None, optimal_n_bars_per_day=50,
+                 use_minute_cache=True, offline=False, bar_sampler=None, cancel_event=None):
         self.symbols = symbols.replace(' ', '').split(',') # convert comma separated string into list
         self.start = start
         self.stop = stop
+        self.incremental = incremental # Boolean: only fetch the days after the bars already stored for a symbol
+        self.optimal_n_bars_per_day = optimal_n_bars_per_day
+        self.bar_sampler = bar_sampler # String: None builds dollar bars (build_dollar_bars), or a streaming sampler in Bar_Sampler.bar_sampling_rules
+        self.volatility_features = default_volatility_features if volatility_features is None else volatility_features # Dictionary: key=estimator, value=list of windows
+
+        # Concurrent day fetching
+        self.max_workers = max_concurrent_requests if max_workers is None else max_workers # Integer: 1 fetches days sequentially
+        self.rate_limiter = RateLimiter(max_requests_per_second if requests_per_second is None else requests_per_second)
+        self.base_url = polygon_base_url if base_url is None else base_url # String: override to point at a stub server
+        self._sessions = threading.local()
+
+        # Raw minute bars are cached per symbol and day, so bars can be rebuilt without the network
+        self.minute_cache = MinuteBarCache(f'{repo_path}\\Data\\{minute_cache_dir}') if use_minute_cache else None
+        self.offline = offline # Boolean: only use cached minute bars (days that aren't cached are skipped)
+
+        # Multi-symbol pipeline
+        self.max_symbol_prefetch = max_symbol_prefetch_default if max_symbol_prefetch is None else max_symbol_prefetch # Integer: symbols fetched ahead of the one being built
+        self.progress_callback = progress_callback # Callable(symbol, stage, count, total, detail), None prints
+        self.timings = {} # key=symbol, value={'fetch': seconds, 'build': seconds}
+        self.cancel_event = cancel_event # threading.Event: set to stop download_data before the next symbol is built
 
     def download_data(self):
+        # Pipelined ingest: the minute bars of the next max_symbol_prefetch symbols are fetched on background threads
+        # while the current symbol's bars are built, labeled and written on this thread. Building stays serial since
+        # build_dollar_bars already spreads its blocks of days over every core.
+        self.timings = {}
+        n_symbols = len(self.symbols)
+        with ThreadPoolExecutor(max_workers=max(1, self.max_symbol_prefetch)) as executor:
+            fetches = {}
+            for i, symbol in enumerate(self.symbols):
+                for ahead in self.symbols[i:i + max(1, self.max_symbol_prefetch)]:
+                    if ahead not in fetches: fetches[ahead] = executor.submit(self._fetch_symbol, ahead)
+                fetched = fetches.pop(symbol).result()
+                if self.cancelled(): # the fetch may have stopped early, so its minute bars are incomplete
+                    self.report_progress(symbol, 'cancelled', i + 1, n_symbols)
+                    break
+                if fetched is None:
+                    continue
+
+                t0 = time.perf_counter()
+                start, minute_bars = fetched
+                bars_file = self.bars_file(symbol)
+                if start is None: n_bars = self.build_data(symbol, bars_file, minute_bars)
+                else: n_bars = self.build_update(symbol, bars_file, minute_bars, start)
+                self.timings[symbol]['build'] = time.perf_counter() - t0
+                self.report_progress(symbol, 'built', i + 1, n_symbols,
+                                     f'{n_bars} bars in {self.timings[symbol]["build"]:.1f}s')
+
+        total = {stage: sum(timing.get(stage, 0.0) for timing in self.timings.values()) for stage in ('fetch', 'build')}
+        print(f'Downloaded {n_symbols} symbols, fetch {total["fetch"]:.1f}s, build {total["build"]:.1f}s (stage totals overlap)')
+
+    def cancelled(self):
+        return (self.cancel_event is not None) and self.cancel_event.is_set()
+
+    def report_progress(self, symbol, stage, count, total, detail=''):
+        # Per-symbol progress, replace with a callback (progress_callback) to report elsewhere
+        if self.progress_callback is not None:
+            self.progress_callback(symbol, stage, count, total, detail)
+        else:
+            print(f'{symbol}: {stage} ({count}/{total}) {detail}'.rstrip())
+
+    def _fetch_symbol(self, symbol):
+        # Network stage of the pipeline, returns (start, minute_bars) where start is None for a full download,
+        # or None if there is nothing to fetch. Streaming samplers read finished days back from the minute bar cache
+        # while they build, so for them minute_bars only holds the records of the days that aren't cached
+        # ({day: records}).
+        t0 = time.perf_counter()
+        start = None
+        bars_file = self.bars_file(symbol)
+        if self.incremental and self._can_update(bars_file):
+            start = self._update_start(bars_file)
+            if start is None:
+                self.report_progress(symbol, 'up to date', self.symbols.index(symbol) + 1, len(self.symbols))
+                return None
+        if self._samples_from_cache():
+            minute_bars = dict(self.fetch_minute_results(symbol, start, keep_cached=False))
+            detail = f'{len(minute_bars)} uncached days'
+        else:
+            minute_bars = self.get_minute_bars(symbol, start=start)
+            detail = f'{len(minute_bars)} minute bars'
+        self.timings[symbol] = {'fetch': time.perf_counter() - t0}
+        self.report_progress(symbol, 'fetched', self.symbols.index(symbol) + 1, len(self.symbols),
+                             f'{detail} in {self.timings[symbol]["fetch"]:.1f}s')
+        return start, minute_bars
+
+    def _samples_from_cache(self):
+        return (self.bar_sampler is not None) and (self.minute_cache is not None)
+
+    def _update_start(self, bars_file):
+        # Incremental updates keep every stored bar but the last one (it was force-closed at the end of the old data)
+        # and continue the bars from there. Returns the close time of the last kept bar, None if up to date.
+        bar_times = read_bars(bars_file, ['datetime']).datetime
+        last_kept_bar_time = bar_times.iloc[-2] if len(bar_times) > 1 else bar_times.iloc[0] - pd.Timedelta(1, 'ns')
+        return None if last_kept_bar_time.normalize() > self.stop else last_kept_bar_time
+
+    def build_data(self, symbol, bars_file, minute_bars):
+        # Builds, labels and writes the bars of a full download, returns the number of bars written
+        if self.bar_sampler is None:
+            daily_dollar_values = self.compute_daily_dollar_values(minute_bars)
+            df = self.build_dollar_bars(minute_bars, optimal_n_bars_per_day=self.optimal_n_bars_per_day, daily_dollar_values=daily_dollar_values)
+        elif self._samples_from_cache():
+            df = self.sample_cached_bars(symbol, self.bar_sampler, uncached_days=minute_bars)
+        else:
+            df = self.sample_bars(minute_bars, self.bar_sampler)
+        df = df.sort_index(ascending=True) # sort by datetime
+        df.reset_index(inplace=True) # set datetime as its own column
+
+        # Label features
+        df = self.label_log_features(df)
+        df = self.label_volatility_features(df)
+
+        # Output fully labeled bars (daily dollar values are kept for incremental updates)
+        df.dropna(how='any', axis='rows', inplace=True)
+        df = label_volatility_features(df, self.volatility_features) # after dropna, so long windows don't drop rows
+        write_bars(df, bars_file)
+        if self.bar_sampler is None: self._write_daily_dollar_values(daily_dollar_values, bars_file)
+        return len(df)
+
+    def build_update(self, symbol, bars_file, minute_bars, last_kept_bar_time):
+        # Appends the bars built from the minutes after last_kept_bar_time (see _update_start) to the stored bars,
+        # minute_bars start on the day of last_kept_bar_time. Returns the number of new bars.
+        if len(minute_bars) == 0:
+            print(f'No new data, {symbol}')
+            return 0
+        stored = read_bars(bars_file)
+        daily = read_bars(os.path.join(bars_file, daily_dollar_values_dir))
+        kept = stored[stored.datetime <= last_kept_bar_time]
+
+        # Thresholds for the new days roll over the stored daily dollar values
+        daily_dollar_values = daily.set_index('datetime').dollar_value
+        daily_dollar_values = pd.concat([daily_dollar_values[daily_dollar_values.index < last_kept_bar_time.normalize()], self.compute_daily_dollar_values(minute_bars)])
+        tail_bars = self.build_dollar_bars(minute_bars[minute_bars.index > last_kept_bar_time], optimal_n_bars_per_day=self.optimal_n_bars_per_day,
+                                           daily_dollar_values=daily_dollar_values, previous_bar_close=kept.close.iloc[-1] if len(kept) > 0 else None)
+        tail_bars = tail_bars.sort_index(ascending=True)
+        tail_bars.reset_index(inplace=True)
+
+        # Recompute features for the new bars only, with the previous estimation_window bars as context
+        context = kept[list(tail_bars.columns)].tail(estimation_window)
+        df = pd.concat([context, tail_bars], ignore_index=True)
+        df = self.label_log_features(df)
+        df = self.label_volatility_features(df)
+        df = df.iloc[len(context):].copy()
+        if len(kept) > 0: # cumsum_log_rets continues from the last kept bar
+            df['cumsum_log_rets'] = kept.cumsum_log_rets.iloc[-1] * np.exp(df.log_rets.cumsum())
+        df.dropna(how='any', axis='rows', inplace=True)
+
+        # Pipeline volatility features are recomputed over the whole series (they are vectorized, and EWM estimators
+        # depend on every earlier bar)
+        df = pd.concat([kept, df[[col for col in kept.columns if col in df.columns]]], ignore_index=True)
+        df = label_volatility_features(df, self._volatility_features_to_store(kept.columns), skip_existing=False)
+        write_bars(df, bars_file)
+        self._write_daily_dollar_values(daily_dollar_values, bars_file)
+        return len(df) - len(kept)
+
+    def update_features(self):
+        # Adds missing volatility features to the stored bars of every symbol without re-downloading
         for symbol in self.symbols:
-            # Download bars
-            df = self.get_polygon_bars(symbol)
-            df = df.sort_index(ascending=True) # sort by datetime
-            df.reset_index(inplace=True) # set datetime as its own column
-
-            # Label features
-            df = self.label_log_features(df)
-            df = self.label_volatility_features(df)
-
-            # Output fully labeled bars
-            df.dropna(how='any', axis='rows', inplace=True)
-            df.to_pickle(f'{repo_path}\\Data\\{symbol}.pkl')
-    
+            added = update_bar_features(self.bars_file(symbol), self.volatility_features)
+            print(f'{symbol}: added {added}')
+
+    def _volatility_features_to_store(self, columns):
+        # Requested volatility features plus the ones already stored
+        volatility_features = {estimator: list(windows) for estimator, windows in self.volatility_features.items()}
+        for col in columns:
+            parsed = parse_volatility_column(col)
+            if parsed is None: continue
+            estimator, window = parsed
+            if window not in volatility_features.setdefault(estimator, []): volatility_features[estimator].append(window)
+        return volatility_features
+
+    def bars_file(self, symbol):
+        # Bars from the streaming samplers are stored next to the dollar bars as <symbol>_<sampler>
+        if self.bar_sampler is None:
+            return f'{repo_path}\\Data\\{symbol}'
+        return f'{repo_path}\\Data\\{symbol}_{self.bar_sampler}'
+
+    def _can_update(self, bars_file):
+        # Incremental updates need columnar bars with their stored daily dollar values
+        if self.bar_sampler is not None:
+            print('Incremental updates only support dollar bars, downloading the full range')
+            return False
+        if os.path.isfile(os.path.join(bars_file, daily_dollar_values_dir, meta_file_name)):
+            return True
+        print(f'No stored daily dollar values in {bars_file}, downloading the full range')
+        return False
+
+    def _write_daily_dollar_values(self, daily_dollar_values, bars_file):
+        # Stored as a columnar directory inside the bars directory
+        daily = daily_dollar_values.rename('dollar_value').rename_axis('datetime').reset_index()
+        write_bars(daily, os.path.join(bars_file, daily_dollar_values_dir))
+
     def get_polygon_bars(self, symbol):
-        # url{} = ticker, date, date, apikey
-        url = 'https://api.polygon.io/v2/aggs/ticker/{}/range/1/minute/{}/{}?adjusted=true&sort=asc&limit=1440&apiKey={}'
-        delta = dt.timedelta(days=1)
-    
-        session = requests.Session()
-        retries = Retry(total=5, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
-        session.mount('http://', HTTPAdapter(max_retries=retries))
-
-        count = 0
-        datecount = self.start
-        num_iters = int((self.stop - self.start) / delta)
-        minute_bars = pd.DataFrame()
-
-        while datecount <= self.stop:
-            r = session.get(url.format(symbol, datecount.date(), datecount.date(), apikey))
-            if r:
-                data = r.json()
-                if data['resultsCount'] > 0:
-                    temp = pd.DataFrame(data['results'])
-                    minute_bars = pd.concat([minute_bars, temp], axis='rows')
-                    print(f'{symbol}: {round((count / num_iters) * 100, 2)}% ({count}/{num_iters})')
-                else:
-                    print(f'No data, {symbol}, {datecount}')
-            else:
-                print(f'No response, {symbol}, {datecount}')
-            count += 1
-            datecount += delta
-            
-        # Rename required cols then drop redundant cols
-        minute_bars['datetime'] = pd.to_datetime(minute_bars['t'], unit='ms')
-        minute_bars['month'] = minute_bars.datetime.dt.strftime('%m')
-        minute_bars = minute_bars.rename(columns={
-            'o': 'open',
-            'h': 'high',
-            'l': 'low',
-            'c': 'close',
-            'v': 'volume',
-            'n': 'trades'})
-        minute_bars.set_index(keys='datetime', drop=True, inplace=True)
-        minute_bars = minute_bars[['open', 'high', 'low', 'close', 'volume', 'trades', 'month']]
-
-        # Build dollar bars
-        df = self.build_dollar_bars(minute_bars)
-        return df
+        return self.build_dollar_bars(self.get_minute_bars(symbol), optimal_n_bars_per_day=self.optimal_n_bars_per_day)
+
+    def get_minute_bars(self, symbol, start=None):
+        # Stream each day's records into typed column buffers, then build the minute bars DataFrame once
+        accumulator = MinuteBarAccumulator()
+        for day, records in self.fetch_minute_results(symbol, start):
+            accumulator.append(records)
+        return accumulator.to_frame()
+
+    def fetch_minute_results(self, symbol, start=None, keep_cached=True):
+        # Loads every day between start (self.start if None) and stop from the minute bar cache, or with up to
+        # max_workers requests in flight. Returns [(day, records), ...] in date order for the days that have data.
+        # keep_cached=False only returns the days that are not in the cache afterwards (days that haven't finished).
+        first_day = (self.start if start is None else start).date()
+        days = [first_day + dt.timedelta(days=i) for i in range((self.stop.date() - first_day).days + 1)]
+
+        num_iters = len(days)
+        day_results = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            futures = {executor.submit(self._load_day, symbol, day): day for day in days}
+            for count, future in enumerate(as_completed(futures), start=1):
+                day = futures[future]
+                records = future.result()
+                if records is None:
+                    print(f'No {"cached data" if self.offline else "response"}, {symbol}, {day}')
+                elif len(records) == 0:
+                    print(f'No data, {symbol}, {day}')
+                elif keep_cached or (self.minute_cache is None) or (not self.minute_cache.contains(symbol, day)):
+                    day_results[day] = records
+                if (count * 10) // num_iters > ((count - 1) * 10) // num_iters: # every 10% of the days
+                    self.report_progress(symbol, 'fetching days', count, num_iters)
+
+        return [(day, day_results[day]) for day in days if day in day_results]
+
+    def _load_day(self, symbol, day):
+        # Returns the day's minute records from the cache or polygon.io (empty if the market was closed), or None if
+        # the request failed or the day is not cached in offline mode. Only finished days (see is_finished_day) are cached.
+        if self.minute_cache is not None:
+            records = self.minute_cache.read(symbol, day)
+            if records is not None:
+                return records
+        if self.offline or self.cancelled():
+            return None
+
+        results = self._fetch_day(symbol, day)
+        if results is None:
+            return None
+        records = MinuteBarAccumulator.to_records(results)
+        if (self.minute_cache is not None) and is_finished_day(day):
+            self.minute_cache.write(symbol, day, records)
+        return records
 
-    def build_dollar_bars(self, minute_bars, optimal_n_bars_per_day=50, n_jobs=-1):
-        input_columns = ['open', 'high', 'low', 'close', 'volume', 'trades', 'month']
+    def _fetch_day(self, symbol, day):
+        # Returns the day's list of minute aggs ([] if the market was closed), or None if the request failed
+        url = polygon_aggs_url.format(self.base_url, symbol, day, day, apikey)
+        session = self._get_session()
+        for attempt in range(request_retries + 1):
+            self.rate_limiter.wait()
+            try:
+                r = session.get(url, timeout=30)
+            except requests.exceptions.RequestException:
+                time.sleep(0.1 * 2 ** attempt)
+                continue
+            if not r:
+                return None
+            data = r.json()
+            if data.get('resultsCount', 0) > 0:
+                return data['results']
+            return []
+        return None
+
+    def _get_session(self):
+        # requests.Session is not thread-safe, so each fetch thread gets its own
+        session = getattr(self._sessions, 'session', None)
+        if session is None:
+            session = requests.Session()
+            retries = Retry(total=5, backoff_factor=0.1, status_forcelist=[429, 500, 502, 503, 504], respect_retry_after_header=True)
+            session.mount('http://', HTTPAdapter(max_retries=retries))
+            session.mount('https://', HTTPAdapter(max_retries=retries))
+            self._sessions.session = session
+        return session
+
+    def sample_bars(self, minute_bars, sampler, chunk_minutes=sampler_chunk_minutes):
+        # Samples bars with one of the streaming samplers in Bar_Sampler (dollar, volume, tick, tick_imbalance),
+        # feeding minute bars that are already in memory through in chunks (used without a minute bar cache, see
+        # sample_cached_bars for the bounded memory path).
+        rule = bar_sampling_rules[sampler]()
+        thresholds = daily_thresholds(rule.daily_totals(minute_bars), self.optimal_n_bars_per_day, threshold_window)
+        bar_sampler = BarSampler(rule, thresholds)
+        return bar_sampler.sample(minute_bars.iloc[i:i + chunk_minutes] for i in range(0, len(minute_bars), chunk_minutes))
+
+    def sample_cached_bars(self, symbol, sampler, days_per_chunk=sampler_chunk_days, uncached_days=None):
+        # Samples bars straight from the minute bar cache, days_per_chunk days at a time, so memory does not grow with
+        # the length of the history (used by build_data for the streaming samplers). The daily totals behind the
+        # thresholds are read in a first pass. uncached_days ({day: records}) adds days that aren't in the cache.
+        uncached_days = {} if uncached_days is None else uncached_days
+        days = sorted(set(day for day in self.minute_cache.days(symbol) if self.start.date() <= day <= self.stop.date()) | set(uncached_days))
+        rule = bar_sampling_rules[sampler]()
+        daily_totals = pd.concat([rule.daily_totals(self._cached_minute_bars(symbol, [day], uncached_days)) for day in days])
+        bar_sampler = BarSampler(rule, daily_thresholds(daily_totals, self.optimal_n_bars_per_day, threshold_window))
+        return bar_sampler.sample(self._cached_minute_bars(symbol, days[i:i + days_per_chunk], uncached_days) for i in range(0, len(days), days_per_chunk))
+
+    def _cached_minute_bars(self, symbol, days, uncached_days):
+        accumulator = MinuteBarAccumulator()
+        for day in days:
+            records = uncached_days.get(day)
+            accumulator.append(self.minute_cache.read(symbol, day) if records is None else records)
+        return accumulator.to_frame()
+
+    def compute_daily_dollar_values(self, minute_bars):
+        daily_dollar_values = minute_bars.close.resample('1D').mean() * minute_bars.volume.resample('1D').sum()
+        return daily_dollar_values.dropna()
+
+    def build_dollar_bars(self, minute_bars, optimal_n_bars_per_day=50, n_jobs=-1, daily_dollar_values=None, previous_bar_close=None):
+        input_columns = ['open', 'high', 'low', 'close', 'volume', 'trades']
         assert isinstance(minute_bars, pd.DataFrame)
         assert list(minute_bars.columns) == input_columns, f'Expected {input_columns} columns, got {list(minute_bars.columns)} instead.'
         assert isinstance(minute_bars.index, pd.DatetimeIndex)
         assert minute_bars.index.is_monotonic_increasing
         assert minute_bars.index.is_unique
 
-        daily_dollar_values = minute_bars.close.resample('1D').mean() * minute_bars.volume.resample('1D').sum()
-        mean_daily_dollar_values = daily_dollar_values.dropna().rolling(60, min_periods=1).mean()
-        thresholds = (mean_daily_dollar_values / optimal_n_bars_per_day).rename('threshold')
+        # daily_dollar_values may reach back before minute_bars (incremental updates), it covers at least minute_bars
+        if daily_dollar_values is None: daily_dollar_values = self.compute_daily_dollar_values(minute_bars)
+        thresholds = daily_thresholds(daily_dollar_values, optimal_n_bars_per_day, threshold_window)
         assert thresholds.index.is_monotonic_increasing
-        
-        minute_bars_grouped_by_contract = minute_bars.groupby(
-            'month',
-            sort=False
-        )
-    
-        dollar_bars_per_contract = Parallel(n_jobs=n_jobs, verbose=5, max_nbytes=None)(
-            delayed(self._build_dollar_bars)(
-                minute_bars=contract_minute_bars[1],
-                thresholds=thresholds,
-            ) for contract_minute_bars in minute_bars_grouped_by_contract
-        )
-    
-        dollar_bars = pd.concat(dollar_bars_per_contract, axis=0)
-        return dollar_bars
+
+        # One continuous stream of bars built in parallel over blocks of build_chunk_days days (see build_threshold_bars)
+        return build_threshold_bars(minute_bars, DollarBarRule(), thresholds, n_jobs=n_jobs, chunk_days=build_chunk_days,
+                                    previous_bar_close=previous_bar_close)
 
     def label_log_features(self, df):
         df['log_rets'] = df.close.apply(np.log).diff(1)
@@ -128,116 +447,8 @@ class DataDownloader():
         return df
 
 
-    def _build_dollar_bars(self, minute_bars, thresholds):
-        assert len(minute_bars.month.unique()) == 1, 'Must create OHLCV bars for one bar at a time'
-
-        # Put the input OHLCV and the dollar bar thresholds in the same DF to avoid the performance overhead of having to
-        # search for the threshold by index inside the loop.
-        ohlcv_and_thresh = pd.merge_asof(
-            minute_bars,
-            thresholds,
-            left_index=True,
-            right_index=True,
-            # If indices don't match, use the latest threshold whose timestamp is <= the current input bar.
-            direction='backward'
-        )
-    
-        bars_list = []
-    
-        minute_volumes = []
-        dollar_value_cumsum = 0
-        volume_cumsum = 0
-        buy_volume_cumsum = 0
-        bars_counter = 0
-        buy_bars_counter = 0
-        highest_high = float('-inf')
-        lowest_low = float('inf')
-        open_of_first_bar = None
-        previous_close = minute_bars.iloc[0].close
-        final_close_timestamp = minute_bars.index[-1]
-    
-        # Performance note: itertuples() is much faster than iterrows()
-        for row in ohlcv_and_thresh.itertuples():
-            dollar_value_cumsum += row.close * row.volume
-            volume_cumsum += row.volume
-            bars_counter += 1
-            minute_volumes.append(row.volume)
-    
-            # `open_of_first_bar` is set to None after the creation of each new dollar bar.
-            if open_of_first_bar is None:
-                open_of_first_bar = row.open
-    
-            if row.high > highest_high:
-                highest_high = row.high
-    
-            if row.low < lowest_low:
-                lowest_low = row.low
-    
-            if row.close > previous_close:
-                # According to the tick rule, this is a "buy tick" (by "tick", I mean 1-minute bar)
-                buy_bars_counter += 1
-                buy_volume_cumsum += row.volume
-    
-            # Build a bar if the dollar value threshold was reached OR if it's the last available 1-minute bar
-            if dollar_value_cumsum >= row.threshold or row.Index == final_close_timestamp:
-                dollar_bar = {
-                    'datetime': row.Index,
-                    'open': open_of_first_bar,
-                    'high': highest_high,
-                    'low': lowest_low,
-                    'close': row.close,
-                    'volume': volume_cumsum,
-                    'buy_volume': buy_volume_cumsum,
-                    'minutes': bars_counter,
-                    'bull_minutes': buy_bars_counter,
-                    'dollar_volume': dollar_value_cumsum,
-                    'intrabar_volume_trend': self._pearson_corr_with_monotonic_increasing(minute_volumes),
-                }
-                bars_list.append(dollar_bar)
-    
-                # Reset variables to start gathering data for the next bar
-                dollar_value_cumsum = 0
-                volume_cumsum = 0
-                buy_volume_cumsum = 0
-                buy_bars_counter = 0
-                highest_high = float('-inf')
-                lowest_low = float('inf')
-                open_of_first_bar = None
-                minute_volumes = []
-    
-                previous_close = row.close
-    
-        dollar_bars = pd.DataFrame(bars_list).set_index('datetime', drop=True)
-    
-        dtypes = {
-            'open': float,
-            'high': float,
-            'low': float,
-            'close': float,
-            'volume': float,
-            'buy_volume': int,
-            'minutes': int,
-            'bull_minutes': int,
-            'dollar_volume': float,
-            'intrabar_volume_trend': float,
-        }
-        dollar_bars = dollar_bars.astype(dtypes)
-    
-        return dollar_bars
-    
-    def _pearson_corr_with_monotonic_increasing(self, minute_volumes):
-        # Sometimes a single 1-minute bar has enough volume to produce a dollar bar. There is no way to calculate a
-        # correlation with a single value. A correlation calculate with 2 values is also not very useful as it will often
-        # have an extreme value.
-        if len(minute_volumes) < 3:
-            # 0.0 is neutral
-            return 0.0
-
-        return np.corrcoef(minute_volumes, np.arange(len(minute_volumes)))[0][1]
-
-    def _compute_stdev_volatility(self, df):
-        return df.close.rolling(estimation_window).std()
+    def _compute_stdev_volatility(self, df, window=estimation_window):
+        return df.close.rolling(window).std()
     
-    def _compute_madev_volatility(self, df):
-        mad = lambda x: np.fabs(x - x.mean()).mean()
-        return df.close.rolling(estimation_window).apply(mad, raw=True)
\ No newline at end of file
+    def _compute_madev_volatility(self, df, window=estimation_window):
+        return pd.Series(rolling_mean_absolute_deviation(df.close.to_numpy(dtype=float), window), index=df.index)
\ No newline at end of file
@@ -0,0 +1,61 @@
+import numpy as np
+
+def consecutive_positive_closes(log_rets):
+    # Running count of consecutive bars with positive log_rets ending at each bar (nan counts as a non-positive close)
+    positive = np.asarray(log_rets, dtype=float) > 0
+    idx = np.arange(len(positive))
+    last_non_positive = np.maximum.accumulate(np.where(positive, -1, idx))
+    return np.where(positive, idx - last_non_positive, 0)
+
+def resolve_exits(close, log_rets, entry_indices, exit_signals_triggered, maxhold, profitable_closes,
+                  profit_targets=None, stop_losses=None, strategy_direction='Long'):
+    # Resolves the first exit bar of every entry at once. Works on raw numpy arrays instead of per-bar DataFrame lookups.
+    # Returns (exit_vector, position_counts), where position_counts[i] is the number of positions held during bar i
+    # (not including the entry bar itself, which is marked by the entry col).
+    close = np.asarray(close, dtype=float)
+    exit_signals_triggered = np.asarray(exit_signals_triggered).astype(bool)
+    n_bars = len(close)
+
+    exit_vector = np.zeros(n_bars)
+    position_counts = np.zeros(n_bars)
+    entry_indices = np.atleast_1d(np.asarray(entry_indices, dtype=np.int64))
+    entry_indices = entry_indices[entry_indices < n_bars - maxhold]
+    if len(entry_indices) == 0 or maxhold < 1:
+        return exit_vector, position_counts
+
+    # Replaces re-scanning every rets_bin with all(...): the bars since entry are all profitable closes
+    # exactly when the running counter at bar i is at least the number of bars held
+    run_lengths = consecutive_positive_closes(log_rets)
+
+    if profit_targets is not None: pt = np.asarray(profit_targets, dtype=float)[entry_indices]
+    if stop_losses is not None: sl = np.asarray(stop_losses, dtype=float)[entry_indices]
+
+    # Step every still-open position forward one bar at a time (O(maxhold) vectorized passes over the entries)
+    exit_bars = entry_indices + maxhold
+    still_open = np.ones(len(entry_indices), dtype=bool)
+    for bars_held in range(1, maxhold + 1):
+        open_positions = np.flatnonzero(still_open)
+        if len(open_positions) == 0:
+            break
+        i = entry_indices[open_positions] + bars_held
+
+        hit = exit_signals_triggered[i] | (bars_held == maxhold) # exit signal and maxhold
+        if bars_held >= profitable_closes:
+            hit |= run_lengths[i] >= bars_held # profitable closes
+        if profit_targets is not None: # PT
+            if strategy_direction == 'Long': hit |= close[i] >= pt[open_positions]
+            else: hit |= close[i] <= pt[open_positions]
+        if stop_losses is not None: # SL
+            if strategy_direction == 'Long': hit |= close[i] <= sl[open_positions]
+            else: hit |= close[i] >= sl[open_positions]
+
+        exit_bars[open_positions[hit]] = i[hit]
+        still_open[open_positions[hit]] = False
+
+    # Mark exits and count active positions over (entry, exit] with a difference array
+    exit_vector[exit_bars] = 1
+    deltas = np.zeros(n_bars + 1)
+    np.add.at(deltas, entry_indices + 1, 1)
+    np.add.at(deltas, exit_bars + 1, -1)
+    position_counts = np.cumsum(deltas[:-1])
+    return exit_vector, position_counts
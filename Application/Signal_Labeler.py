@@ -1,11 +1,64 @@
+import threading
+import itertools
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 
+signal_cache_size = 256 # Max number of signal columns kept in memory (least recently used are evicted first)
+
+_signal_cache = OrderedDict() # key=(cache_key, signal, params), value=(signal_label, np.ndarray)
+_signal_cache_lock = threading.Lock()
+
+# Parametric comparison signals: key=signal_name, value=(left column, operator, right column)
+parametric_comparisons = {'open[] > open[]': ('open', '>', 'open'),
+                          'open[] > high[]': ('open', '>', 'high'),
+                          'open[] > low[]': ('open', '>', 'low'),
+                          'open[] > close[]': ('open', '>', 'close'),
+                          'open[] <= open[]': ('open', '<=', 'open'),
+                          'open[] <= high[]': ('open', '<=', 'high'),
+                          'open[] <= low[]': ('open', '<=', 'low'),
+                          'open[] <= close[]': ('open', '<=', 'close')}
+
+comparison_operators = {'>': np.greater, '<=': np.less_equal}
+
+def clear_signal_cache():
+    with _signal_cache_lock:
+        _signal_cache.clear()
+
+def expand_signal_param_bin(signal_param_bin):
+    # Expands [['A', base, max, step], ['B', base, max, step]] into every combination of parameter values,
+    # each returned as a resolved bin [['A', value, None, None], ['B', value, None, None]].
+    # A parameter without a usable max/step only takes its base value.
+    param_values = []
+    for param, base, max_, step in signal_param_bin:
+        if (base is None) or (max_ is None) or (step is None) or (step <= 0) or (max_ <= base):
+            param_values.append([base])
+        else:
+            param_values.append(list(range(base, max_ + 1, step)))
+
+    param_names = [param_sub_bin[0] for param_sub_bin in signal_param_bin]
+    return [[[param, value, None, None] for param, value in zip(param_names, values)] for values in itertools.product(*param_values)]
+
+def _signal_cache_entry_key(cache_key, signal, signal_params_dict):
+    params = tuple(sorted(signal_params_dict.items())) if signal_params_dict else None
+    return (cache_key, signal, params)
+
+def _shift(values, periods):
+    # numpy equivalent of pd.Series.shift for float columns
+    shifted = np.full(len(values), np.nan)
+    if periods >= 0:
+        if periods < len(values): shifted[periods:] = values[:len(values) - periods]
+    else:
+        if -periods < len(values): shifted[:periods] = values[-periods:]
+    return shifted
+
 class LabelSignals():
-    def __init__(self, data, signals, signals_param_bins):
+    def __init__(self, data, signals, signals_param_bins, cache_key=None):
         self.data = data # Dollar bars DataFrame
         self.signals = signals # List of strings
         self.signals_param_bins = signals_param_bins # Double nested List: [[['A', base, max, step], ['B', base, max, step]], [['A', base, max, step], ['B', base, max, step], ['C...', base, max, step]]]
+        self.cache_key = cache_key # Hashable identifying the bars (e.g. file path and mtime), None disables the signal cache
     
     def label(self):
 
@@ -35,7 +88,7 @@ class LabelSignals():
                     signal_params_dict[param_sub_bin[0]] = param_sub_bin[1]
 
                 # Label signal and append label to list
-                data, signal_label = signalMethods[signal](data, signal_params_dict)
+                data, signal_label = self._label_signal(signalMethods, data, signal, signal_params_dict)
                 signal_labels.append(signal_label)
 
             # Return fully labeled dataset
@@ -45,10 +98,84 @@ class LabelSignals():
         else:
             for signal in self.signals:
                 # Label signal
-                data, signal_label = signalMethods[signal](data, None)
+                data, signal_label = self._label_signal(signalMethods, data, signal, None)
                 signal_labels.append(signal_label)
             # Return fully labeled dataset
             return data, signal_labels
+
+    def _label_signal(self, signalMethods, data, signal, signal_params_dict):
+        # Signal columns only depend on the bars and the signal parameters, so they are computed once per
+        # (bars, signal, parameters) and reused across grid points and repeated tests
+        if self.cache_key is None:
+            return signalMethods[signal](data, signal_params_dict)
+
+        key = _signal_cache_entry_key(self.cache_key, signal, signal_params_dict)
+        with _signal_cache_lock:
+            cached = _signal_cache.get(key)
+            if cached is not None: _signal_cache.move_to_end(key)
+
+        if (cached is not None) and (len(cached[1]) == len(data)):
+            signal_label, values = cached
+            data[signal_label] = values
+            return data, signal_label
+
+        data, signal_label = signalMethods[signal](data, signal_params_dict)
+        values = data[signal_label].to_numpy(copy=True)
+        values.setflags(write=False)
+        with _signal_cache_lock:
+            _signal_cache[key] = (signal_label, values)
+            _signal_cache.move_to_end(key)
+            while len(_signal_cache) > signal_cache_size:
+                _signal_cache.popitem(last=False)
+        return data, signal_label
+
+    def cache_parametric_batch(self, signal, signal_param_bins):
+        # Labels many parameter combinations of one comparison signal at once and stores them in the signal cache:
+        # each distinct shift of the left/right columns is computed once, then all masks are built as a single
+        # 2-D (combinations x bars) matrix. label() then picks the columns up from the cache.
+        if (self.cache_key is None) or (signal not in parametric_comparisons):
+            return
+
+        # Resolve parameter dicts and skip combinations that are already cached
+        signal_params_dicts = []
+        with _signal_cache_lock:
+            for signal_param_bin in signal_param_bins:
+                signal_params_dict = {param_sub_bin[0]: param_sub_bin[1] for param_sub_bin in signal_param_bin}
+                if (signal_params_dict.get('A') is None) or (signal_params_dict.get('B') is None):
+                    continue
+                key = _signal_cache_entry_key(self.cache_key, signal, signal_params_dict)
+                if (key not in _signal_cache) and (signal_params_dict not in signal_params_dicts):
+                    signal_params_dicts.append(signal_params_dict)
+        if len(signal_params_dicts) == 0:
+            return
+
+        left_col, operator, right_col = parametric_comparisons[signal]
+        left_values = self.data[left_col].to_numpy(dtype=float)
+        right_values = self.data[right_col].to_numpy(dtype=float)
+
+        # Shift each column once per distinct parameter value
+        A_values = sorted(set(d['A'] for d in signal_params_dicts))
+        B_values = sorted(set(d['B'] for d in signal_params_dicts))
+        left_shifted = np.vstack([_shift(left_values, A) for A in A_values])
+        right_shifted = np.vstack([_shift(right_values, B) for B in B_values])
+        A_row_lookup = {A: row for row, A in enumerate(A_values)}
+        B_row_lookup = {B: row for row, B in enumerate(B_values)}
+        A_rows = np.array([A_row_lookup[d['A']] for d in signal_params_dicts])
+        B_rows = np.array([B_row_lookup[d['B']] for d in signal_params_dicts])
+
+        # One vectorized pass over every combination (nan comparisons are False, as in the single signal methods)
+        with np.errstate(invalid='ignore'):
+            masks = comparison_operators[operator](left_shifted[A_rows], right_shifted[B_rows]).astype(int)
+        masks.setflags(write=False)
+
+        with _signal_cache_lock:
+            for signal_params_dict, values in zip(signal_params_dicts, masks):
+                signal_label = '{}[{:.2f}] {} {}[{:.2f}]'.format(left_col, signal_params_dict['A'], operator, right_col, signal_params_dict['B'])
+                key = _signal_cache_entry_key(self.cache_key, signal, signal_params_dict)
+                _signal_cache[key] = (signal_label, values)
+                _signal_cache.move_to_end(key)
+            while len(_signal_cache) > signal_cache_size:
+                _signal_cache.popitem(last=False)
     
     #
     # Seasonalities (Non-parametric)
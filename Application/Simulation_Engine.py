@@ -1,10 +1,16 @@
 import numpy as np
 import pandas as pd
 import itertools
+import warnings
 
-from Signal_Labeler import LabelSignals
+from joblib import Parallel, delayed
+
+from Signal_Labeler import LabelSignals, expand_signal_param_bin, signal_cache_size
+from Exit_Kernel import resolve_exits
+from Bar_Store import get_bar_store, resolve_bars_file
 
 round_tolerance = 3
+portfolio_frequency = '1D' # Portfolio mode sums each symbol's strategy_rets per period of this length before combining them (None = every bar timestamp)
 
 repo_path = 'C:\\Users\\14843\\Documents\\GitHub\\Trading-Strategy-Simulator'
 labeled_bars_path = f'{repo_path}\\Data'
@@ -13,13 +19,82 @@ def nearest_no_lookahead(items, pivot):
     # Returns the nearest date before the given date to prevent lookahead bias
     return min([i for i in items if i <= pivot], key = lambda x: abs(x - pivot))
 
+def run_tasks(calls, n_jobs=1, cancel_event=None):
+    # Yields function(*args) for every (function, args) in calls, in order. Parallel results are streamed as soon as
+    # they (and every earlier call) finish. Once cancel_event (threading.Event) is set no further results are yielded
+    # and the calls that haven't started are dropped.
+    if n_jobs == 1:
+        for function, args in calls:
+            if (cancel_event is not None) and cancel_event.is_set():
+                return
+            yield function(*args)
+        return
+
+    results = Parallel(n_jobs=n_jobs, backend='loky', return_as='generator')(delayed(function)(*args) for function, args in calls)
+    try:
+        for result in results:
+            if (cancel_event is not None) and cancel_event.is_set():
+                return
+            yield result
+    finally:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore') # joblib warns about the calls it drops
+            results.close() # aborts the pending calls
+
+class SimulationResult():
+    # Metrics and parameters of one test. Sweeps keep these instead of the labeled DataFrames, only the top_k results
+    # by Sharpe ratio keep their performance curve.
+    __slots__ = ('symbol', 'strategy_direction', 'num_trades', 'entry_params', 'exit_params', 'pt_mult', 'sl_mult', 'maxhold',
+                 'profitable_closes', 'sharpe_ratio', 'sortino_ratio', 'signals_and_params', 'strategy_rets', 'performance_curve')
+
+    # Numeric fields of the typed record array (to_records)
+    record_fields = {'num_trades': np.int64, 'pt_mult': np.float64, 'sl_mult': np.float64, 'maxhold': np.float64,
+                     'profitable_closes': np.float64, 'sharpe_ratio': np.float64, 'sortino_ratio': np.float64}
+    record_dtype = np.dtype(list(record_fields.items()))
+
+    def __init__(self, symbol, strategy_direction, num_trades, entry_params, exit_params, pt_mult, sl_mult, maxhold, profitable_closes,
+                 sharpe_ratio, sortino_ratio, signals_and_params=None):
+                self.symbol = symbol # String
+                self.strategy_direction = strategy_direction # String
+                self.num_trades = num_trades # Integer
+                self.entry_params = entry_params # String
+                self.exit_params = exit_params # String
+                self.pt_mult = pt_mult # Float or None
+                self.sl_mult = sl_mult # Float or None
+                self.maxhold = maxhold # Integer
+                self.profitable_closes = profitable_closes # Integer
+                self.sharpe_ratio = sharpe_ratio # Float
+                self.sortino_ratio = sortino_ratio # Float
+                self.signals_and_params = signals_and_params # Dictionary the test was run with (shared with the signal parameter grid)
+                self.strategy_rets = None # pd.Series, only kept while a portfolio is being combined
+                self.performance_curve = None # pd.Series, only kept for the top_k results
+
+    @classmethod
+    def to_records(cls, results):
+        # Structured array of the results' numeric fields (None becomes nan), for sorting and filtering large result sets
+        n = len(results)
+        records = np.empty(n, dtype=cls.record_dtype)
+        for field, dtype in cls.record_fields.items():
+            missing = 0 if field == 'num_trades' else np.nan
+            records[field] = np.fromiter((missing if getattr(r, field) is None else getattr(r, field) for r in results), dtype=dtype, count=n)
+        return records
+
+    def row(self):
+        # Strategy output table row
+        return [self.symbol, self.strategy_direction, str(self.num_trades), self.entry_params, self.exit_params, str(self.sharpe_ratio), str(self.sortino_ratio)]
+
+    def sort_key(self):
+        # Sharpe ratio, nan last
+        return -np.inf if np.isnan(self.sharpe_ratio) else self.sharpe_ratio
+
 class SimulationEngine():
     def __init__(self, strategy_direction, symbol, entry_checks, exit_checks, non_parametric_checks, signals_and_params,
                  volatility_calculation, pt_multiplier, sl_multiplier, max_holding_bars, profitable_closes,
-                 pt_mult_delta3, sl_mult_delta3, maxhold_delta3, profitable_closes_delta3):
+                 pt_mult_delta3, sl_mult_delta3, maxhold_delta3, profitable_closes_delta3, n_jobs=1, top_k=0):
                 self.strategy_direction = strategy_direction # String
 
                 self.symbol = symbol # String
+                self.bars_file = resolve_bars_file(labeled_bars_path, symbol) # String (resolved here so sweep workers read the same file)
 
                 self.entry_checks = entry_checks # List of strings (signal names)
                 self.exit_checks = exit_checks # List of strings (signal names)
@@ -41,34 +116,112 @@ class SimulationEngine():
                 self.maxhold_delta3 = maxhold_delta3 # Integer
                 self.profitable_closes_delta3 = profitable_closes_delta3 # Integer
 
+                # Parallel sweep
+                self.n_jobs = n_jobs # Integer: number of worker processes for the parameter sweep (1 = serial, -1 = all cores)
+
+                # Results
+                self.top_k = top_k # Integer: number of results (by Sharpe ratio) that keep their performance curve
+                self.keep_strategy_rets = False # Boolean: results keep strategy_rets (set by PortfolioSimulationEngine)
+
                 # Empty variables
                 self.num_trades = 0
                 
-    def Simulate(self):
+    def Simulate(self, result_callback=None, progress_callback=None, cancel_event=None):
+        # result_callback(results) receives the SimulationResults of every task as soon as it finishes and
+        # progress_callback(n_done, n_tasks) follows it. Setting cancel_event (threading.Event) stops the sweep,
+        # the databin then only holds the finished tasks.
+        parameter_grid = self.build_parameter_grid()
+        signal_parameter_batches = self._batch_signal_parameter_grid(self.build_signal_parameter_grid())
+
+        # Each task runs one batch of signal parameter combinations at one PT/SL/maxhold/profitable closes grid point.
+        # Tasks only carry the engine settings, each worker process reads the symbol's bars once into its own
+        # bar store and labels each batch's signal columns once into its own signal cache.
+        calls = [(self.run_batch, (signal_parameter_batch, args)) for signal_parameter_batch in signal_parameter_batches for args in parameter_grid]
+        task_results = []
+        for results in run_tasks(calls, self.n_jobs, cancel_event):
+            task_results.append(results)
+            if result_callback is not None: result_callback(results)
+            if progress_callback is not None: progress_callback(len(task_results), len(calls))
+
+        # Order databin (SimulationResults) by signal parameter combination, then by grid point
         databin = []
-        pt_mult_bin = [self.pt_multiplier]
-        sl_mult_bin = [self.sl_multiplier]
-        maxhold_bin = [self.max_holding_bars]
-        profitable_closes_bin = [self.profitable_closes]
+        for batch_idx, signal_parameter_batch in enumerate(signal_parameter_batches):
+            batch_results = task_results[batch_idx * len(parameter_grid):(batch_idx + 1) * len(parameter_grid)]
+            for combination_idx in range(len(signal_parameter_batch)):
+                for results in batch_results:
+                    databin.append(results[combination_idx]) # append contents into databin
+        self.keep_top_performance_curves(databin)
+        return databin
+
+    def run_batch(self, signal_parameter_batch, args):
+        # Returns one SimulationResult per signal parameter combination, the labeled DataFrames are dropped here
+        self.label_signal_parameter_batch(signal_parameter_batch)
+        results = []
+        for signals_and_params in signal_parameter_batch:
+            data, result = self.run_test(args[0], args[1], args[2], args[3], signals_and_params)
+            if self.keep_strategy_rets: result.strategy_rets = data.strategy_rets
+            results.append(result)
+        return results
+
+    def keep_top_performance_curves(self, results):
+        # Re-runs the top_k results by Sharpe ratio to attach their performance curves (cheaper than keeping every curve)
+        for result in sorted(results, key=SimulationResult.sort_key, reverse=True)[:max(0, self.top_k)]:
+            data, _ = self.run_test(result.pt_mult, result.sl_mult, result.maxhold, result.profitable_closes, result.signals_and_params)
+            result.performance_curve = data.performance_curve
+
+    def build_signal_parameter_grid(self):
+        # Expand the [param, base, max, step] rows of every checked signal into all parameter combinations.
+        # Returns a list of signals_and_params dictionaries with the parameter values resolved.
+        checked_signals = list(dict.fromkeys(self.entry_checks + self.exit_checks))
+        expanded_bins = [expand_signal_param_bin(self.signals_and_params[signal]) for signal in checked_signals]
+
+        signal_parameter_grid = []
+        for signal_param_bins in itertools.product(*expanded_bins):
+            signals_and_params = dict(self.signals_and_params)
+            signals_and_params.update(zip(checked_signals, signal_param_bins))
+            signal_parameter_grid.append(signals_and_params)
+        return signal_parameter_grid
+
+    def label_signal_parameter_batch(self, signal_parameter_batch):
+        # Label the signal columns of a whole batch in one vectorized pass per signal (results go to the signal cache)
+        data = self.read_in_data()
+        labeler = LabelSignals(data, [], [], self._signal_cache_key())
+        for signal in dict.fromkeys(self.entry_checks + self.exit_checks):
+            labeler.cache_parametric_batch(signal, [signals_and_params[signal] for signals_and_params in signal_parameter_batch])
+
+    def _batch_signal_parameter_grid(self, signal_parameter_grid):
+        # Batches are sized so that all signal columns of a batch fit in the signal cache at once
+        n_signals = max(1, len(self.entry_checks) + len(self.exit_checks))
+        batch_size = max(1, signal_cache_size // n_signals)
+        return [signal_parameter_grid[i:i + batch_size] for i in range(0, len(signal_parameter_grid), batch_size)]
+
+    def build_parameter_grid(self):
+        pt_multiplier = self.pt_multiplier
+        sl_multiplier = self.sl_multiplier
+        max_holding_bars = self.max_holding_bars
+        profitable_closes = self.profitable_closes
+
+        pt_mult_bin = [pt_multiplier]
+        sl_mult_bin = [sl_multiplier]
+        maxhold_bin = [max_holding_bars]
+        profitable_closes_bin = [profitable_closes]
 
         for _ in range(3):
-            if self.pt_multiplier is not None: self.pt_multiplier += self.pt_mult_delta3
-            if self.sl_multiplier is not None: self.sl_multiplier += self.sl_mult_delta3
-            self.max_holding_bars += self.maxhold_delta3
-            self.profitable_closes += self.profitable_closes_delta3
+            if pt_multiplier is not None: pt_multiplier += self.pt_mult_delta3
+            if sl_multiplier is not None: sl_multiplier += self.sl_mult_delta3
+            max_holding_bars += self.maxhold_delta3
+            profitable_closes += self.profitable_closes_delta3
 
-            if (self.pt_multiplier not in pt_mult_bin) and (self.pt_multiplier is not None): pt_mult_bin.append(self.pt_multiplier)
-            if (self.sl_multiplier not in sl_mult_bin) and (self.sl_multiplier is not None): sl_mult_bin.append(self.sl_multiplier)
-            if (self.max_holding_bars not in maxhold_bin) and (self.max_holding_bars is not None): maxhold_bin.append(self.max_holding_bars)
-            if (self.profitable_closes not in profitable_closes_bin) and (self.profitable_closes is not None): profitable_closes_bin.append(self.profitable_closes)
+            if (pt_multiplier not in pt_mult_bin) and (pt_multiplier is not None): pt_mult_bin.append(pt_multiplier)
+            if (sl_multiplier not in sl_mult_bin) and (sl_multiplier is not None): sl_mult_bin.append(sl_multiplier)
+            if (max_holding_bars not in maxhold_bin) and (max_holding_bars is not None): maxhold_bin.append(max_holding_bars)
+            if (profitable_closes not in profitable_closes_bin) and (profitable_closes is not None): profitable_closes_bin.append(profitable_closes)
 
-        for args in itertools.product(pt_mult_bin, sl_mult_bin, maxhold_bin, profitable_closes_bin):
-            databin.append(self.run_test(args[0], args[1], args[2], args[3])) # append contents into databin
+        return list(itertools.product(pt_mult_bin, sl_mult_bin, maxhold_bin, profitable_closes_bin))
 
-        return databin
-            
+    def run_test(self, pt_mult, sl_mult, maxhold, profitable_closes, signals_and_params=None):
+        if signals_and_params is None: signals_and_params = self.signals_and_params
 
-    def run_test(self, pt_mult, sl_mult, maxhold, profitable_closes):
         # 1) Read in base data (features were pre-labeled during the data download)
         data = self.read_in_data()
 
@@ -77,29 +230,34 @@ class SimulationEngine():
         if sl_mult is not None: data = self.label_sl(data, sl_mult)
 
         # 3) Label entry signals and entry_signals_combined
-        data.reset_index(inplace=True)
-        data, entry_indices, entry_vector_length = self.label_entries(data)
+        data, entry_indices, entry_vector_length = self.label_entries(data, signals_and_params)
 
         # 4) Label exit signals and exit_signals_combined
-        data = self.label_exits_and_active_positions(data, entry_indices, entry_vector_length, pt_mult, sl_mult, maxhold, profitable_closes)
+        data = self.label_exits_and_active_positions(data, signals_and_params, entry_indices, entry_vector_length, pt_mult, sl_mult, maxhold, profitable_closes)
         data.set_index(keys='datetime', inplace=True) # set index back to datetime
 
         # 5) Label strategy_rets, performance_curve, then compute and return performance metrics
         data.dropna(how='any', axis='rows', inplace=True) # drop any rows that contain nans
-        return self.compute_and_label_performance_metrics(data, pt_mult, sl_mult, maxhold, profitable_closes)
+        data, result = self.compute_and_label_performance_metrics(data, pt_mult, sl_mult, maxhold, profitable_closes)
+        result.signals_and_params = signals_and_params
+        return data, result
 
     # 1) Read in data
     def read_in_data(self):
-        data = pd.read_pickle(f'{labeled_bars_path}\\{self.symbol}')
-        data.datetime = pd.to_datetime(data.datetime)
-        data.set_index(keys='datetime', drop=True, inplace=True)
-        data.sort_index(ascending=True, inplace=True)
-
-        # Invert log_rets if its a short selling strategy
-        if self.strategy_direction == 'Short':
-            data.log_rets *= -1
-        
-        return data
+        # Bars are read, parsed, sorted and direction-adjusted once per symbol by the shared bar store,
+        # each run only gets a view of the columns it needs (datetime column, RangeIndex)
+        bar_store = get_bar_store(self.bars_file)
+        return bar_store.view(self._required_columns(), self.strategy_direction)
+
+    def _signal_cache_key(self):
+        # Signal columns are cached per bars file version (reading the store again only stats the file)
+        bar_store = get_bar_store(self.bars_file)
+        return (bar_store.path, bar_store.mtime)
+
+    def _required_columns(self):
+        columns = ['open', 'high', 'low', 'close', 'log_rets']
+        if self.volatility_calculation is not None: columns.append(self.volatility_calculation)
+        return columns
 
     # 2a) Label PT
     def label_pt(self, data, pt_mult):
@@ -114,14 +272,14 @@ class SimulationEngine():
         return data
 
     # 3) Label entry signals and entry col
-    def label_entries(self, data):
+    def label_entries(self, data, signals_and_params):
         # Get signal parameter bins
         signals_param_bins = []
         for entry_signal in self.entry_checks:
-            signals_param_bins.append(self.signals_and_params[entry_signal])
+            signals_param_bins.append(signals_and_params[entry_signal])
 
         # Label signal cols and compute entry indices
-        data, self.entry_labels = LabelSignals(data, self.entry_checks, signals_param_bins).label() # data, signals, signal_param_bins
+        data, self.entry_labels = LabelSignals(data, self.entry_checks, signals_param_bins, self._signal_cache_key()).label() # data, signals, signal_param_bins
         entry_signals_arr = np.transpose(np.array(data[self.entry_labels]))
         entry_signals_triggered = (entry_signals_arr==1).all(axis=0).astype(int)
         entry_indices = np.argwhere(np.diff(np.pad(entry_signals_triggered, 1)) == 1).squeeze() # array of entry indices
@@ -135,59 +293,31 @@ class SimulationEngine():
         entry_indices = np.argwhere(np.diff(np.pad(data.entry, 1)) == 1).squeeze() # re-compute entry_indices to remove lookahead bias
         return data, entry_indices, vector_shape[0]
 
-    # 4) Label exit signals, exit col, and active_positions *USE NUMBA TO SPEED UP*
-    def label_exits_and_active_positions(self, data, entry_indices, entry_vector_length, pt_mult, sl_mult, maxhold, profitable_closes):
+    # 4) Label exit signals, exit col, and active_positions
+    def label_exits_and_active_positions(self, data, signals_and_params, entry_indices, entry_vector_length, pt_mult, sl_mult, maxhold, profitable_closes):
 
         # Get signal parameter bins
         signals_param_bins = []
         for exit_signal in self.exit_checks:
-            signals_param_bins.append(self.signals_and_params[exit_signal])
+            signals_param_bins.append(signals_and_params[exit_signal])
 
         # Label signal cols and compute exit_signals_triggered
-        data, self.exit_labels = LabelSignals(data, self.exit_checks, signals_param_bins).label() # data, signals, signal_param_bins
+        data, self.exit_labels = LabelSignals(data, self.exit_checks, signals_param_bins, self._signal_cache_key()).label() # data, signals, signal_param_bins
         exit_signals_arr = np.transpose(np.array(data[self.exit_labels]))
         exit_signals_triggered = (exit_signals_arr==1).all(axis=0).astype(int)
 
         # Label exits and active_positions
-        active_positions_vector = data.entry.copy()
-        entry_indices = entry_indices[entry_indices < entry_vector_length - maxhold]
-        exit_vector = np.zeros(entry_vector_length)
-        for idx in entry_indices:
-            if pt_mult is not None: pt = data.loc[idx, 'profit_target']
-            if sl_mult is not None: sl = data.loc[idx, 'stop_loss']
-            end = idx + maxhold
-            rets_bin = []
-            for i in range(idx + 1, end + 1):
-                active_positions_vector[i] += 1
-                rets_bin.append(data.loc[i, 'log_rets'])
-                if exit_signals_triggered[i]: # exit signal
-                    exit_vector[i] = 1
-                    break
-                elif (len(rets_bin) >= profitable_closes) and all(item > 0 for item in rets_bin): # profitable closes
-                    exit_vector[i] = 1
-                    break
-                elif i == end: # maxhold
-                    exit_vector[i] = 1
-                    break
-                else: # PT and SL
-                    if pt_mult is not None:
-                        if self.strategy_direction == 'Long':
-                            if data.loc[i, 'close'] >= pt:
-                                exit_vector[i] = 1
-                                break
-                        else:
-                            if data.loc[i, 'close'] <= pt:
-                                exit_vector[i] = 1
-                                break
-                    if sl_mult is not None:
-                        if self.strategy_direction == 'Long':
-                            if data.loc[i, 'close'] <= sl:
-                                exit_vector[i] = 1
-                                break
-                        else:
-                            if data.loc[i, 'close'] >= sl:
-                                exit_vector[i] = 1
-                                break
+        exit_vector, position_counts = resolve_exits(
+            close=data.close.values,
+            log_rets=data.log_rets.values,
+            entry_indices=entry_indices,
+            exit_signals_triggered=exit_signals_triggered,
+            maxhold=maxhold,
+            profitable_closes=profitable_closes,
+            profit_targets=data.profit_target.values if pt_mult is not None else None,
+            stop_losses=data.stop_loss.values if sl_mult is not None else None,
+            strategy_direction=self.strategy_direction)
+        active_positions_vector = data.entry + position_counts
         data['exit'] = pd.Series(exit_vector).shift(1)
         data['active_positions'] = active_positions_vector  
         return data
@@ -203,14 +333,104 @@ class SimulationEngine():
         exit_params = ",".join(self.exit_labels + [f'PT {pt_mult}'] + [f'SL {sl_mult}'] + [f'Maxhold {maxhold}'] + [f'Profitable Closes {profitable_closes}'])
 
         # Compute metrics
-        sharpe_ratio = str(self._compute_sharpe_ratio(data.strategy_rets))
-        sortino_ratio = str(self._compute_sortino_ratio(data.strategy_rets))
+        sharpe_ratio = self._compute_sharpe_ratio(data.strategy_rets)
+        sortino_ratio = self._compute_sortino_ratio(data.strategy_rets)
 
         # Return contents
-        return data, [self.symbol, self.strategy_direction, str(self.num_trades), entry_params, exit_params, sharpe_ratio, sortino_ratio]
+        return data, SimulationResult(self.symbol, self.strategy_direction, self.num_trades, entry_params, exit_params,
+                                      pt_mult, sl_mult, maxhold, profitable_closes, sharpe_ratio, sortino_ratio)
 
     def _compute_sharpe_ratio(self, rets):
         return int(np.mean(rets) / np.std(rets) * float(10 ** round_tolerance) + 0.5) / float(10 ** round_tolerance)
 
     def _compute_sortino_ratio(self, rets):
-        return int(np.mean(rets) / np.std(rets[rets < 0]) * float(10 ** round_tolerance) + 0.5) / float(10 ** round_tolerance)
\ No newline at end of file
+        return int(np.mean(rets) / np.std(rets[rets < 0]) * float(10 ** round_tolerance) + 0.5) / float(10 ** round_tolerance)
+
+class PortfolioSimulationEngine():
+    # Runs the same entry/exit specification on several symbols in one sweep. Each (signal batch, symbol, grid point)
+    # is one task, so the sweep runs in parallel across symbols too. Signal columns are cached per bars file, so every
+    # symbol's columns live side by side in each worker's signal cache.
+    def __init__(self, strategy_direction, symbols, entry_checks, exit_checks, non_parametric_checks, signals_and_params,
+                 volatility_calculation, pt_multiplier, sl_multiplier, max_holding_bars, profitable_closes,
+                 pt_mult_delta3, sl_mult_delta3, maxhold_delta3, profitable_closes_delta3, n_jobs=1, frequency=portfolio_frequency, top_k=0):
+                self.symbols = symbols # List of strings
+                self.engines = [SimulationEngine(strategy_direction, symbol, entry_checks, exit_checks, non_parametric_checks, signals_and_params,
+                                                 volatility_calculation, pt_multiplier, sl_multiplier, max_holding_bars, profitable_closes,
+                                                 pt_mult_delta3, sl_mult_delta3, maxhold_delta3, profitable_closes_delta3) for symbol in symbols]
+                self.strategy_direction = strategy_direction # String
+                self.n_jobs = n_jobs # Integer: number of worker processes (1 = serial, -1 = all cores)
+                self.frequency = frequency # String: pandas offset alias of the common timeline, or None
+                self.top_k = top_k # Integer: number of portfolio results (by Sharpe ratio) that keep their performance curve
+                for engine in self.engines: engine.keep_strategy_rets = True
+
+    def Simulate(self, result_callback=None, progress_callback=None, cancel_event=None):
+        # Returns a databin like SimulationEngine.Simulate, where every signal parameter combination and grid point gets
+        # a combined portfolio row followed by one row per symbol. result_callback receives those rows as soon as every
+        # symbol of a batch and grid point has finished, progress_callback and cancel_event work as in SimulationEngine.
+        parameter_grid = self.engines[0].build_parameter_grid()
+        signal_parameter_batches = self.engines[0]._batch_signal_parameter_grid(self.engines[0].build_signal_parameter_grid())
+
+        # Grid points of one symbol and batch are adjacent, so consecutive tasks reuse the same cached signal columns
+        calls = [(engine.run_batch, (signal_parameter_batch, args)) for signal_parameter_batch in signal_parameter_batches
+                 for engine in self.engines for args in parameter_grid]
+        n_symbols = len(self.engines)
+        n_grid_points = len(parameter_grid)
+        task_results = []
+        combined_results = {} # key=(batch_idx, grid_idx), value=combined SimulationResult of every signal parameter combination
+        for results in run_tasks(calls, self.n_jobs, cancel_event):
+            task_results.append(results)
+            batch_idx, task_idx = divmod(len(task_results) - 1, n_symbols * n_grid_points)
+            symbol_idx, grid_idx = divmod(task_idx, n_grid_points)
+            if symbol_idx == n_symbols - 1: # the last symbol of this batch and grid point
+                rows = []
+                combined_results[(batch_idx, grid_idx)] = []
+                for combination_idx in range(len(results)):
+                    symbol_results = [task_results[(batch_idx * n_symbols + i) * n_grid_points + grid_idx][combination_idx] for i in range(n_symbols)]
+                    combined_results[(batch_idx, grid_idx)].append(self.combine_results(symbol_results))
+                    rows += [combined_results[(batch_idx, grid_idx)][-1]] + symbol_results
+                if result_callback is not None: result_callback(rows)
+            if progress_callback is not None: progress_callback(len(task_results), len(calls))
+
+        databin = []
+        for batch_idx, signal_parameter_batch in enumerate(signal_parameter_batches):
+            for combination_idx in range(len(signal_parameter_batch)):
+                for grid_idx in range(n_grid_points):
+                    if (batch_idx, grid_idx) not in combined_results: # cancelled
+                        continue
+                    databin.append(combined_results[(batch_idx, grid_idx)][combination_idx])
+                    databin.extend(task_results[(batch_idx * n_symbols + symbol_idx) * n_grid_points + grid_idx][combination_idx]
+                                   for symbol_idx in range(n_symbols))
+
+        # Only the top_k portfolio results keep a performance curve
+        portfolio_results = databin[::n_symbols + 1]
+        for result in sorted(portfolio_results, key=SimulationResult.sort_key, reverse=True)[:max(0, self.top_k)]:
+            result.performance_curve = result.strategy_rets.cumsum().apply(np.exp)
+        for result in portfolio_results:
+            result.strategy_rets = None
+        return databin
+
+    def combine_results(self, symbol_results):
+        # Aligns the symbols' strategy_rets on a common timeline (summed per frequency period, 0 for a symbol without bars
+        # in a period where others have some) and combines them with equal weights. Each symbol's Sharpe and Sortino
+        # ratios are recomputed on that timeline too, so the symbol rows are comparable with the combined row. The
+        # symbols' strategy_rets are released here.
+        symbol_rets = []
+        for result in symbol_results:
+            rets = result.strategy_rets
+            if self.frequency is not None: rets = rets.resample(self.frequency).sum(min_count=1)
+            symbol_rets.append(rets)
+            result.strategy_rets = None
+        aligned_rets = pd.concat(symbol_rets, axis=1, keys=self.symbols).dropna(how='all').fillna(0.0)
+        strategy_rets = aligned_rets.mean(axis=1)
+        for symbol, result in zip(self.symbols, symbol_results):
+            result.sharpe_ratio = self.engines[0]._compute_sharpe_ratio(aligned_rets[symbol])
+            result.sortino_ratio = self.engines[0]._compute_sortino_ratio(aligned_rets[symbol])
+
+        # Parameters are the same for every symbol
+        first = symbol_results[0]
+        combined = SimulationResult(','.join(self.symbols), self.strategy_direction, sum(result.num_trades for result in symbol_results),
+                                    first.entry_params, first.exit_params, first.pt_mult, first.sl_mult, first.maxhold, first.profitable_closes,
+                                    self.engines[0]._compute_sharpe_ratio(strategy_rets), self.engines[0]._compute_sortino_ratio(strategy_rets),
+                                    first.signals_and_params)
+        combined.strategy_rets = strategy_rets
+        return combined
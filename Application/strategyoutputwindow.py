@@ -17,11 +17,10 @@ class Ui_StrategyOutputWindow(object):
         StrategyOutputWindow.resize(1291, 805)
         self.centralwidget = QtWidgets.QWidget(StrategyOutputWindow)
         self.centralwidget.setObjectName("centralwidget")
-        self.StrategyOutput_tablewidget = QtWidgets.QTableWidget(self.centralwidget)
-        self.StrategyOutput_tablewidget.setGeometry(QtCore.QRect(0, 0, 1291, 791))
-        self.StrategyOutput_tablewidget.setObjectName("StrategyOutput_tablewidget")
-        self.StrategyOutput_tablewidget.setColumnCount(0)
-        self.StrategyOutput_tablewidget.setRowCount(0)
+        self.StrategyOutput_tableview = QtWidgets.QTableView(self.centralwidget)
+        self.StrategyOutput_tableview.setGeometry(QtCore.QRect(0, 0, 1291, 791))
+        self.StrategyOutput_tableview.setSortingEnabled(True)
+        self.StrategyOutput_tableview.setObjectName("StrategyOutput_tableview")
         StrategyOutputWindow.setCentralWidget(self.centralwidget)
         self.statusbar = QtWidgets.QStatusBar(StrategyOutputWindow)
         self.statusbar.setObjectName("statusbar")